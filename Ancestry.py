@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Ancestry.py
+
+Ancestry recording backend.  Instead of copying segments into every offspring, each meiosis is
+stored as edges (child, parent, left, right): the child's chromosome between left and right was
+inherited from that parent.  Founder of origin is found at query time by following edges back to
+the founders, and simplify() removes edges that are no longer ancestral to the living population.
+"""
+from __future__ import division
+import itertools
+
+from numpy import *
+from Chromosomes import *
+import Population
+import Instrumentation
+
+
+def unionIntervals(rows, lefts, rights):
+    """Merges overlapping or touching intervals of each row.  Returns the rows, lefts and rights of the union,
+       sorted by row and then position."""
+    order = lexsort((lefts, rows))
+    rows, lefts, rights = rows[order], lefts[order], rights[order]
+    if len(rows) == 0:
+        return rows, lefts, rights
+    #running maximum of the right ends within each row, on integer ranks so that rows never mix
+    values = unique(concatenate((lefts, rights)))
+    group = concatenate(([0], cumsum(rows[1:] != rows[:-1])))
+    scale = len(values) + 1
+    reach = maximum.accumulate(group * scale + searchsorted(values, rights))
+    newInterval = ones(len(rows), dtype = bool)
+    newInterval[1:] = (group[1:] != group[:-1]) | (searchsorted(values, lefts[1:]) > reach[:-1] - group[1:] * scale)
+    ends = append(nonzero(newInterval)[0][1:], len(rows)) - 1
+    return rows[newInterval], lefts[newInterval], values[reach[ends] - group[ends] * scale]
+
+def spliceEdges(starts, codes, offsets, children, parents, lefts, rights, nChildren):
+    """Segment arrays for a generation from its parents' segment table and its edges, which are sorted by child and left end.
+       Parts of a chromosome not covered by any edge (removed by simplify) get the parent code -1.
+       Returns the starts, codes and offsets of the children's table."""
+    keys = repeat(arange(len(offsets) - 1), diff(offsets)) + 1j * starts
+    first = searchsorted(keys, parents + 1j * lefts, side = "right")
+    last = searchsorted(keys, parents + 1j * rights, side = "left")
+    bodyLengths = maximum(last - first, 0)
+    bodyIndex = arange(bodyLengths.sum()) + repeat(first - (cumsum(bodyLengths) - bodyLengths), bodyLengths)
+
+    #gaps before an edge that does not start where the previous edge of its child ended, and after each child's last edge
+    firstOfChild = ones(len(children), dtype = bool)
+    firstOfChild[1:] = children[1:] != children[:-1]
+    previousEnd = where(firstOfChild, 0.0, concatenate(([0.0], rights[:-1])))
+    gapBefore = lefts > previousEnd
+    lastOfChild = ones(len(children), dtype = bool)
+    lastOfChild[:-1] = firstOfChild[1:]
+    gapAfter = lastOfChild & (rights < 1)
+    uncovered = nonzero(bincount(children, minlength = nChildren) == 0)[0]
+
+    entryChild = concatenate((children, repeat(children, bodyLengths), children[gapBefore], children[gapAfter], uncovered))
+    entryStart = concatenate((lefts, starts[bodyIndex], previousEnd[gapBefore], rights[gapAfter], zeros(len(uncovered))))
+    entryCode = concatenate((codes[first - 1], codes[bodyIndex], -ones(gapBefore.sum() + gapAfter.sum() + len(uncovered), dtype = int32)))
+    order = lexsort((entryStart, entryChild))
+    entryChild, entryStart, entryCode = entryChild[order], entryStart[order], entryCode[order]
+
+    #remove redundant segments, keeping the first segment of every child
+    keep = ones(len(entryCode), dtype = bool)
+    keep[1:] = (entryCode[1:] != entryCode[:-1]) | (entryChild[1:] != entryChild[:-1])
+    newOffsets = concatenate(([0], cumsum(bincount(entryChild[keep], minlength = nChildren))))
+    return entryStart[keep], entryCode[keep].astype(int32), newOffsets
+
+
+class AncestryTables(object):
+    """Ancestry graph shared by the generations of an AncestryPopulation.
+       Generation 0 is a HaploidPopulation of roots; each later generation records its size, the generation its parents
+       came from, and for each chromosome the edges (children, parents, lefts, rights), with children and parents given as
+       row numbers within their generations and edges sorted by child and left end.
+       epoch counts the simplifications, each of which invalidates every generation that existed before it except
+       the one simplified."""
+    def __init__(self, roots):
+        self.roots = roots
+        self.sizes = [len(roots)]
+        self.parentGenerations = [None]
+        self.edges = [None]
+        self.epoch = 0
+
+    def addGeneration(self, parentGeneration, size, edges):
+        self.sizes.append(size)
+        self.parentGenerations.append(parentGeneration)
+        self.edges.append(edges)
+        return len(self.sizes) - 1
+
+    def lineage(self, generation):
+        """Generations from generation back to the roots, newest first"""
+        chain = list()
+        while generation != None:
+            chain.append(generation)
+            generation = self.parentGenerations[generation]
+        return chain
+
+    nEdges = property(fget = lambda self: sum(len(e[0]) for edges in self.edges if edges != None for e in edges),
+                      doc = "Number of edges stored")
+
+
+class AncestryPopulation(object):
+    """Population of haploids that records each meiosis in an AncestryTables graph instead of copying segments.
+       founders is a HaploidPopulation or list of haploids; simplifyInterval, if given, runs simplify() every that many generations."""
+    def __init__(self, founders = None, tables = None, generation = 0, names = None, simplifyInterval = None):
+        if (founders is None) == (tables is None):
+            raise ValueError, "Must specify only one of either the founders or the ancestry tables."
+        if founders is not None:
+            if not isinstance(founders, Population.HaploidPopulation):
+                founders = Population.HaploidPopulation(individuals = founders)
+            tables = AncestryTables(founders)
+            if names is None:
+                names = founders.names
+        self.tables = tables
+        self.generation = generation
+        self.epoch = tables.epoch
+        self.simplifyInterval = simplifyInterval
+        self.sinceSimplify = 0
+        if names is None:
+            names = [None] * len(self)
+        self.names = list(names)
+
+    def __len__(self):
+        return self.tables.sizes[self.generation]
+
+    nChr = property(fget = lambda self: self.tables.roots.nChr, doc = "Number of chromosomes")
+
+    def checkCurrent(self):
+        """Raises ValueError if a later generation has simplified the tables this population's ancestry is read from"""
+        if self.epoch != self.tables.epoch:
+            raise ValueError, "The ancestry of generation %d was trimmed when a later generation was simplified" % self.generation
+
+    def mate(self, rowsA, rowsB, rng = random):
+        """Produces one offspring from each pair of individuals rowsA[i] x rowsB[i], recording the meioses as edges"""
+        self.checkCurrent()
+        rowsA = asarray(rowsA, dtype = int32)
+        rowsB = asarray(rowsB, dtype = int32)
+        if len(rowsA) != len(rowsB):
+            raise ValueError, "Must have the same number of individuals in each set of parents"
+        counts, crossOvers, fromA = Population.drawMeioses(self.tables.roots.tables, len(rowsA), rng)
+        if Instrumentation.enabled:
+            Instrumentation.count("meioses", len(rowsA) * len(crossOvers))
+            #edges are recorded without looking at the parents' segments, so identical parents are not detected
+            Instrumentation.count("uncheckedMeioses", len(rowsA) * len(crossOvers))
+            Instrumentation.count("crossovers", sum(len(c) for c in crossOvers))
+        edges = list()
+        for chrCounts, chrCrossOvers, chrFromA in itertools.izip(counts, crossOvers, fromA):
+            #one edge per block between crossovers, alternating parents
+            meiosis = repeat(arange(len(rowsA), dtype = int32), chrCounts + 1)
+            position = arange(len(meiosis)) - (cumsum(chrCounts + 1) - chrCounts - 1)[meiosis]
+            useA = (position % 2 == 0) == chrFromA[meiosis]
+            lefts = zeros(len(meiosis), dtype = float64)
+            lefts[position > 0] = chrCrossOvers
+            rights = ones(len(meiosis), dtype = float64)
+            rights[position < chrCounts[meiosis]] = chrCrossOvers
+            edges.append((meiosis, where(useA, rowsA[meiosis], rowsB[meiosis]), lefts, rights))
+        generation = self.tables.addGeneration(self.generation, len(rowsA), edges)
+        offspring = AncestryPopulation(tables = self.tables, generation = generation, simplifyInterval = self.simplifyInterval)
+        offspring.sinceSimplify = self.sinceSimplify + 1
+        #observers may still look up the parents, which simplifying can trim
+        if Population.mateObservers:
+            Population.notifyMateObservers(self, offspring, rowsA, rowsB, counts, crossOvers, fromA)
+        if self.simplifyInterval and offspring.sinceSimplify >= self.simplifyInterval:
+            offspring.simplify()
+        return offspring
+
+    def getAncestorsAt(self, chrom, rows, locs, generation = 0):
+        """Row numbers, within an earlier generation of this lineage, of the ancestors from which individuals rows inherited
+           locations locs of chromosome chrom (rows and locs are broadcast against each other)"""
+        self.checkCurrent()
+        rows, locs = broadcast_arrays(asarray(rows, dtype = int64), asarray(locs, dtype = float64))
+        rows = rows.copy()
+        for g in self.tables.lineage(self.generation):
+            if g == generation:
+                return rows
+            children, parents, lefts, rights = self.tables.edges[g][chrom]
+            index = searchsorted(children + 1j * lefts, rows + 1j * locs, side = "right") - 1
+            rows = parents[index].astype(int64)
+        raise ValueError, "Generation %d is not an ancestor of this population" % generation
+
+    def getCodesAtLocations(self, chrom, locs):
+        """(locations x individuals) matrix of parent codes, found by following the edges back to the roots"""
+        locs = asarray(locs, dtype = float64)
+        if len(locs) > 0 and (locs.min() < 0 or locs.max() > 1):
+            raise ValueError, "Locations must be in range [0,1]"
+        rows = self.getAncestorsAt(chrom, arange(len(self))[newaxis, :], locs[:, newaxis])
+        return self.tables.roots.tables[chrom].getCodesAt(rows, locs[:, newaxis])
+
+    def simplify(self):
+        """Removes all edges that are not ancestral to this population, and trims the rest to the parts of the chromosome
+           this population inherited through them.  Edges of generations outside this population's lineage are dropped.
+           The tables are shared, so every other generation created before this call can no longer be queried or mated."""
+        self.checkCurrent()
+        chain = self.tables.lineage(self.generation)
+        for g in range(1, len(self.tables.sizes)):
+            if g not in chain:
+                self.tables.edges[g] = None
+        for chrom in range(self.nChr):
+            #ancestral material of the current generation: whole chromosomes
+            rows = arange(len(self), dtype = int64)
+            lefts = zeros(len(self))
+            rights = ones(len(self))
+            for g in chain[:-1]:
+                children, parents, edgeLefts, edgeRights = self.tables.edges[g][chrom]
+                keys = children + 1j * edgeLefts
+                first = searchsorted(keys, rows + 1j * lefts, side = "right") - 1
+                last = searchsorted(keys, rows + 1j * rights, side = "left") - 1
+                nPieces = maximum(last - first + 1, 0)
+                piece = arange(nPieces.sum()) - repeat(cumsum(nPieces) - nPieces, nPieces)
+                edge = repeat(first, nPieces) + piece
+                child = repeat(rows, nPieces)
+                pieceLefts = maximum(repeat(lefts, nPieces), edgeLefts[edge])
+                pieceRights = minimum(repeat(rights, nPieces), edgeRights[edge])
+                valid = (pieceLefts < pieceRights) & (children[edge] == child)
+                edge, child, pieceLefts, pieceRights = edge[valid], child[valid], pieceLefts[valid], pieceRights[valid]
+
+                #join touching pieces inherited from the same parent
+                parent = parents[edge]
+                joined = zeros(len(edge), dtype = bool)
+                joined[1:] = (child[1:] == child[:-1]) & (parent[1:] == parent[:-1]) & (pieceLefts[1:] == pieceRights[:-1])
+                ends = append(nonzero(~joined)[0][1:], len(edge)) - 1
+                self.tables.edges[g][chrom] = (child[~joined].astype(int32), parent[~joined], pieceLefts[~joined], pieceRights[ends])
+                rows, lefts, rights = unionIntervals(parent.astype(int64), pieceLefts, pieceRights)
+        self.tables.epoch += 1
+        self.epoch = self.tables.epoch
+        self.sinceSimplify = 0
+
+    def toPopulation(self):
+        """HaploidPopulation with the segments of this population, built by applying the edges from the roots forward"""
+        self.checkCurrent()
+        tables = list()
+        for chrom, rootTable in enumerate(self.tables.roots.tables):
+            starts, codes, offsets = rootTable.starts, rootTable.codes, rootTable.offsets
+            for g in reversed(self.tables.lineage(self.generation)[:-1]):
+                children, parents, lefts, rights = self.tables.edges[g][chrom]
+                starts, codes, offsets = spliceEdges(starts, codes, offsets, children, parents, lefts, rights, self.tables.sizes[g])
+            tables.append(SegmentTable(name = rootTable.name, cM = rootTable.cM, interference = rootTable.interference,
+                                       starts = starts, codes = codes, offsets = offsets))
+        return Population.HaploidPopulation(tables = tables, names = self.names)
+
+    def __getitem__(self, i):
+        """Individual i; this rebuilds the whole population, so iterate or use toPopulation() to read many individuals"""
+        return self.toPopulation()[i]
+
+    def __iter__(self):
+        return iter(self.toPopulation())
+
+
+if __name__ == '__main__':
+    population = AncestryPopulation(Population.HaploidPopulation(names = ["a","b","c","d","e","f","g","h"], newChr = 2), simplifyInterval = 5)
+    for _ in range(20):
+        population = population.mate(random.randint(0, len(population), size = 1000),
+                                     random.randint(0, len(population), size = 1000))
+    print "Edges stored: %d" % population.tables.nEdges
+    for chr in population[0].chromosomes:
+        print "Chr %s: %s" % (chr.name, chr.segments)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks.py
+
+Benchmarks for the chromosome segment storage and recombination.  Compares the array layout
+used by Chromosomes.Chromosome with the original layout of (start, parent) tuple lists.
+
+The 'suite' benchmark runs each scenario of the scenarios dictionary in its own process and
+reports its wall time, peak memory and the objects it left allocated, as JSON that later runs
+can be compared against.
+"""
+from __future__ import division
+import sys
+import os
+import gc
+import json
+import time
+import resource
+import subprocess
+import optparse
+
+from numpy import *
+import Chromosomes
+import Individual
+import Population
+import Crosses
+import CrossSim
+
+
+class TupleChromosome(object):
+    """Reference implementation storing segments as a list of (start, parent) tuples"""
+    def __init__(self, cM = 200, name = None, segments = None, newParent = None):
+        self.name = name
+        self.cM = cM
+        self.segments = segments
+        if newParent != None:
+            self.segments = [(0, newParent)]
+
+    def __eq__(self, other):
+        return self.name == other.name and self.segments == other.segments
+
+    def recombine(self, mate):
+        if self == mate:
+            return (TupleChromosome(name = self.name, cM = self.cM, segments = self.segments),
+                    TupleChromosome(name = self.name, cM = self.cM, segments = self.segments))
+        segments1 = list(self.segments)
+        segments2 = list(mate.segments)
+        brokenSegments1 = list()
+        brokenSegments2 = list()
+        for crossOver in Chromosomes.generateBreaksPoisson(self.cM):
+            tempSeg = list()
+            while len(segments1) > 0 and segments1[0][0] < crossOver:
+                tempSeg.append(segments1.pop(0))
+            segments1.insert(0, (crossOver, tempSeg[-1][1]))
+            brokenSegments1.append(tempSeg)
+            tempSeg = list()
+            while len(segments2) > 0 and segments2[0][0] < crossOver:
+                tempSeg.append(segments2.pop(0))
+            segments2.insert(0, (crossOver, tempSeg[-1][1]))
+            brokenSegments2.append(tempSeg)
+        brokenSegments1.append(segments1)
+        brokenSegments2.append(segments2)
+        chr1 = list()
+        chr2 = list()
+        for index, bs1 in enumerate(brokenSegments1):
+            if index % 2 == 0:
+                chr1 += bs1
+                chr2 += brokenSegments2[index]
+            else:
+                chr1 += brokenSegments2[index]
+                chr2 += bs1
+        chr1 = [x for i,x in enumerate(chr1) if (i == 0 or chr1[i][1] != chr1[i-1][1])]
+        chr2 = [x for i,x in enumerate(chr2) if (i == 0 or chr2[i][1] != chr2[i-1][1])]
+        if random.binomial(1, 0.5):
+            return (TupleChromosome(name = self.name, cM = self.cM, segments = chr1),
+                    TupleChromosome(name = self.name, cM = self.cM, segments = chr2))
+        else:
+            return (TupleChromosome(name = self.name, cM = self.cM, segments = chr2),
+                    TupleChromosome(name = self.name, cM = self.cM, segments = chr1))
+
+
+def tupleChromosomeBytes(chrom):
+    """Memory used by a tuple layout chromosome, counting the list, tuples and start positions"""
+    size = sys.getsizeof(chrom) + sys.getsizeof(chrom.__dict__) + sys.getsizeof(chrom.segments)
+    for segment in chrom.segments:
+        size += sys.getsizeof(segment) + sys.getsizeof(segment[0])
+    return size
+
+def arrayChromosomeBytes(chrom):
+    """Memory used by an array layout chromosome, counting the object and both arrays"""
+    return sys.getsizeof(chrom) + sys.getsizeof(chrom.starts) + sys.getsizeof(chrom.codes)
+
+
+def evolve(chrClass, nFounders, nInd, nChr, cM, generations):
+    """Random mating population of haploids, with each individual a list of chromosomes"""
+    population = [[chrClass(cM = cM, name = c, newParent = f) for c in range(nChr)]
+                  for f in range(nFounders)]
+    for _ in range(generations):
+        r1 = random.randint(0, len(population), size = nInd)
+        r2 = random.randint(0, len(population), size = nInd)
+        population = [[c1.recombine(c2)[0] for c1, c2 in zip(population[a], population[b])]
+                      for a, b in zip(r1, r2)]
+    return population
+
+def timeRecombination(population, nMeioses):
+    """Recombinations per second between randomly chosen chromosomes of a population"""
+    r1 = random.randint(0, len(population), size = nMeioses)
+    r2 = random.randint(0, len(population), size = nMeioses)
+    pairs = [(population[a][0], population[b][0]) for a, b in zip(r1, r2)]
+    start = time.time()
+    for c1, c2 in pairs:
+        c1.recombine(c2)
+    return nMeioses / (time.time() - start)
+
+def benchmarkLayouts(nFounders = 8, nInd = 1000, nChr = 5, cM = 200, generations = 10, nMeioses = 20000, seed = 0):
+    """Bytes per individual and recombinations per second for the tuple and array layouts"""
+    results = list()
+    for label, chrClass, sizer in [("tuple", TupleChromosome, tupleChromosomeBytes),
+                                   ("array", Chromosomes.Chromosome, arrayChromosomeBytes)]:
+        random.seed(seed)
+        population = evolve(chrClass, nFounders, nInd, nChr, cM, generations)
+        nBytes = sum(sizer(c) for ind in population for c in ind) / len(population)
+        nSegments = sum(len(c.segments) for ind in population for c in ind) / (len(population) * nChr)
+        results.append((label, nSegments, nBytes, timeRecombination(population, nMeioses)))
+    return results
+
+def segmentedPair(chrClass, nSegments, nFounders = 8, cM = 200):
+    """Two chromosomes with nSegments segments each, at random breakpoints"""
+    pair = list()
+    for _ in range(2):
+        starts = concatenate(([0.0], sort(random.uniform(size = nSegments - 1))))
+        parents = (arange(nSegments) + random.randint(0, nFounders)) % nFounders
+        pair.append(chrClass(cM = cM, name = 1, segments = zip(starts.tolist(), parents.tolist())))
+    return pair
+
+def benchmarkSegmentCounts(segmentCounts = (1, 10, 100, 1000, 10000), minTime = 0.5, seed = 0):
+    """Recombinations per second as a function of the number of segments on each parental chromosome"""
+    results = list()
+    for nSegments in segmentCounts:
+        for label, chrClass in [("tuple", TupleChromosome), ("array", Chromosomes.Chromosome)]:
+            random.seed(seed)
+            c1, c2 = segmentedPair(chrClass, nSegments)
+            nMeioses = 0
+            start = time.time()
+            while time.time() - start < minTime:
+                c1.recombine(c2)
+                nMeioses += 1
+            results.append((label, nSegments, nMeioses / (time.time() - start)))
+    return results
+
+
+def founders(params):
+    """Haploid founders for a scenario"""
+    return [Individual.Haploid(name = f, newChr = params["nChr"], cM = params["cM"]) for f in range(params["founders"])]
+
+def recombineScenario(nSegments):
+    """Recombinations between two chromosomes of nSegments segments"""
+    def scenario(params):
+        c1, c2 = segmentedPair(Chromosomes.Chromosome, nSegments, nFounders = params["founders"], cM = params["cM"])
+        def run():
+            #the products are discarded, so that the peak memory is that of one meiosis
+            for _ in xrange(params["meioses"]):
+                c1.recombine(c2)
+        return run
+    return scenario
+
+def randomCrossScenario(params):
+    """Random mating of a batched population for the given generations"""
+    population = Population.HaploidPopulation(individuals = founders(params))
+    def run():
+        offspring = population
+        for _ in range(params["generations"]):
+            offspring = Crosses.randomCross(offspring, nOffspring = params["nInd"])
+        return offspring
+    return run
+
+def abaCrossScenario(params):
+    parents = founders(params)
+    return lambda: Crosses.abaCross(parents)
+
+def rrCrossScenario(params):
+    parents = founders(params)
+    return lambda: Crosses.rrCross(parents)
+
+def collabCrossScenario(params):
+    parents = founders(params)
+    return lambda: Crosses.collabCross(parents)
+
+def randInfCrossScenario(params):
+    population = Population.HaploidPopulation(individuals = founders(params))
+    return lambda: Crosses.randInfCross(population, params["nInd"], params["generations"])
+
+def rilCrossScenario(params):
+    """Recombinant inbred lines by sib mating, from funnels of all founders"""
+    population = Population.DiploidPopulation(names = range(params["founders"]), newChr = params["nChr"], cM = params["cM"])
+    return lambda: Crosses.rilCross(population, params["nInd"], params["generations"])
+
+def statsScenario(params):
+    """The statistics pass of CrossSim on a randomly mated population"""
+    population = randomCrossScenario(params)()
+    options = CrossSim.getOptions([])
+    return lambda: CrossSim.populationStats(population, range(params["founders"]), options)
+
+def genotypeScenario(params):
+    """Diploid.getAllGenos for every individual of an F2 population"""
+    parents = [Individual.Diploid(name = f, newChr = params["nChr"], cM = params["cM"]) for f in range(2)]
+    F1 = parents[0].mate(parents[1])[0]
+    population = F1.mate(F1, nOffspring = params["nInd"])
+    return lambda: [ind.getAllGenos() for ind in population]
+
+#each scenario sets up its input from the parameters and returns the work to measure
+scenarios = dict([("recombine-%d" % n, recombineScenario(n)) for n in (10, 100, 1000, 10000)] +
+                 [("randomCross", randomCrossScenario), ("abaCross", abaCrossScenario), ("rrCross", rrCrossScenario),
+                  ("collabCross", collabCrossScenario), ("randInfCross", randInfCrossScenario), ("rilCross", rilCrossScenario),
+                  ("stats", statsScenario), ("getAllGenos", genotypeScenario)])
+
+defaultParams = dict(founders = 8, nChr = 5, cM = 200, generations = 10, nInd = 1000, meioses = 2000, seed = 0)
+
+def measureScenario(name, params):
+    """Wall time, peak resident memory (kB) and number of objects left allocated by the work of a scenario, in this process"""
+    random.seed(params["seed"])
+    work = scenarios[name](params)
+    gc.collect()
+    objects = len(gc.get_objects())
+    start = time.time()
+    result = work()
+    seconds = time.time() - start
+    gc.collect()
+    objects = len(gc.get_objects()) - objects
+    del result
+    return dict(seconds = seconds, peakKB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, objects = objects)
+
+def runScenario(name, params):
+    """Measures a scenario in a new process, so that its peak memory is its own"""
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run", name, "--params", json.dumps(params)],
+                             stdout = subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        raise RuntimeError, "Scenario %s failed" % name
+    return json.loads(output)
+
+def benchmarkSuite(names = None, params = defaultParams):
+    """Measurements of each scenario named (all by default), with the parameters used"""
+    if names == None:
+        names = sorted(scenarios)
+    return dict(params = params, results = dict((name, runScenario(name, params)) for name in names))
+
+def compareResults(results, baseline, tolerance = 1.2):
+    """Rows of (scenario, seconds, baseline seconds, ratio, regressed) for the scenarios in both result sets;
+       a scenario has regressed if it took more than tolerance times its baseline time"""
+    rows = list()
+    for name in sorted(results["results"]):
+        if name in baseline["results"]:
+            seconds = results["results"][name]["seconds"]
+            baseSeconds = baseline["results"][name]["seconds"]
+            ratio = seconds / baseSeconds
+            rows.append((name, seconds, baseSeconds, ratio, ratio > tolerance))
+    return rows
+
+
+def getOptions():
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--benchmark", action = "store", dest = "benchmark", default = "layout",
+                      help = "Benchmark to run. One of: 'layout' (memory and speed of the population layouts), 'segments' (recombination speed against segment count), 'suite' (time, memory and objects of each scenario)")
+    parser.add_option("-f", "--founders", action = "store", dest = "founders", type = "int", default = 8,
+                      help = "Number of founders in suite scenarios")
+    parser.add_option("-n", "--nInd", action = "store", dest = "nInd", type = "int", default = 1000,
+                      help = "Number of individuals in each generation")
+    parser.add_option("-c", "--nChr", action = "store", dest = "nChr", type = "int", default = 5,
+                      help = "Number of chromosomes per individual")
+    parser.add_option("-l", "--cM", action = "store", dest = "cM", type = "float", default = 200,
+                      help = "Length of each chromosome in cM")
+    parser.add_option("-g", "--generations", action = "store", dest = "generations", type = "int", default = 10,
+                      help = "Generations of random mating before measuring")
+    parser.add_option("-m", "--meioses", action = "store", dest = "nMeioses", type = "int", default = None,
+                      help = "Number of recombinations to time (default 20000, or %d in suite scenarios)" % defaultParams["meioses"])
+    parser.add_option("-s", "--scenarios", action = "store", dest = "scenarios", default = None,
+                      help = "Comma separated suite scenarios to run (default all)")
+    parser.add_option("-o", "--output", action = "store", dest = "output", default = None,
+                      help = "File to save the suite results to, as JSON")
+    parser.add_option("--baseline", action = "store", dest = "baseline", default = None,
+                      help = "Suite results (JSON) to compare against; exits with status 1 if any scenario is slower than the tolerance allows")
+    parser.add_option("--tolerance", action = "store", dest = "tolerance", type = "float", default = 1.2,
+                      help = "Largest ratio of time to baseline time that does not count as a regression")
+    parser.add_option("--seed", action = "store", dest = "seed", type = "int", default = 0,
+                      help = "Random seed for suite scenarios")
+    parser.add_option("--run", action = "store", dest = "run", default = None,
+                      help = optparse.SUPPRESS_HELP)
+    parser.add_option("--params", action = "store", dest = "params", default = None,
+                      help = optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    return options
+
+def main():
+    options = getOptions()
+    if options.run != None:
+        #a single scenario, in the process started by runScenario
+        print json.dumps(measureScenario(options.run, json.loads(options.params)))
+        return
+    if options.benchmark == "suite":
+        params = dict(defaultParams, founders = options.founders, nChr = options.nChr, cM = options.cM, generations = options.generations,
+                      nInd = options.nInd, seed = options.seed)
+        if options.nMeioses != None:
+            params["meioses"] = options.nMeioses
+        names = None
+        if options.scenarios != None:
+            names = options.scenarios.split(",")
+        results = benchmarkSuite(names, params)
+        print "scenario\tseconds\tpeakKB\tobjects"
+        for name in sorted(results["results"]):
+            result = results["results"][name]
+            print "%s\t%.4f\t%d\t%d" % (name, result["seconds"], result["peakKB"], result["objects"])
+        if options.output != None:
+            with open(options.output, "w") as outFile:
+                json.dump(results, outFile, indent = 1, sort_keys = True)
+        if options.baseline != None:
+            with open(options.baseline) as baseFile:
+                baseline = json.load(baseFile)
+            rows = compareResults(results, baseline, options.tolerance)
+            print "scenario\tseconds\tbaseline\tratio"
+            for name, seconds, baseSeconds, ratio, regressed in rows:
+                print "%s\t%.4f\t%.4f\t%.2f%s" % (name, seconds, baseSeconds, ratio, "\tREGRESSION" if regressed else "")
+            if any([regressed for _, _, _, _, regressed in rows]):
+                sys.exit(1)
+        return
+    if options.benchmark == "segments":
+        print "layout\tsegments\trecombPerSec"
+        for label, nSegments, rate in benchmarkSegmentCounts():
+            print "%s\t%d\t%.0f" % (label, nSegments, rate)
+        return
+    print "layout\tsegsPerChr\tbytesPerInd\trecombPerSec"
+    for label, nSegments, nBytes, rate in benchmarkLayouts(nInd = options.nInd, nChr = options.nChr, cM = options.cM,
+                                                           generations = options.generations, nMeioses = options.nMeioses or 20000):
+        print "%s\t%.2f\t%.0f\t%.0f" % (label, nSegments, nBytes, rate)
+
+if __name__ == '__main__':
+    main()
@@ -6,46 +6,309 @@ Chromosomes.py
 Created by Joshua Shapiro on 2008-08-11.
 """
 from __future__ import division 
+import os
 import itertools
 import operator
+import weakref
+import threading
+import bisect
+from multiprocessing.pool import ThreadPool
 
 
 from numpy import *
+import CrossoverModels
+import Instrumentation
+from CrossoverModels import generateBreaksPoisson
 
+#Parent labels are interned in a table shared by all chromosomes, so segments only need to store an integer code
+parentLabels = list()
+parentCodes = dict()
 
-def generateBreaksPoisson(cM = 200):
-    breaks = random.uniform(size = random.poisson(cM/100.0))
-    breaks.sort()
-    return breaks
+def internParent(parent):
+    """Returns the integer code for a parent label, adding the label to the shared parent table if it is new"""
+    code = parentCodes.get(parent)
+    if code == None:
+        code = len(parentLabels)
+        parentLabels.append(parent)
+        parentCodes[parent] = code
+    return code
+
+#Optional thread pool for the segment splicing of meioses, whose crossovers are always drawn in the calling thread
+meiosisPool = None
+meiosisThreads = 1
+#process the pool was started in: a forked child inherits the pool but not its threads
+meiosisPoolPid = None
+
+def setMeiosisThreads(nThreads):
+    """Splices the chromosomes of meioses on a pool of nThreads threads, or in the calling thread if nThreads is 1"""
+    global meiosisPool, meiosisThreads, meiosisPoolPid
+    if meiosisPool != None and meiosisPoolPid != os.getpid():
+        #the threads of an inherited pool do not exist in this process, so it can only be dropped
+        meiosisPool = None
+        meiosisThreads = 1
+    if nThreads == meiosisThreads:
+        return
+    if meiosisPool != None:
+        meiosisPool.close()
+        meiosisPool = None
+    if nThreads > 1:
+        meiosisPool = ThreadPool(nThreads)
+        meiosisPoolPid = os.getpid()
+    meiosisThreads = nThreads
+
+def mapMeioses(function, *sequences):
+    """map() of function over the sequences, on the meiosis thread pool if there is one"""
+    if len(sequences) == 0:
+        return []
+    if meiosisPool == None or len(sequences[0]) < 2 or meiosisPoolPid != os.getpid():
+        return map(function, *sequences)
+    return meiosisPool.map(lambda args: function(*args), zip(*sequences))
+
+
+#parents with at most this many segments between them are spliced as lists, which is faster than the array operations
+#for short arrays (see Benchmarks.py -b segments)
+smallSplice = 128
+
+def spliceSegments(startsA, codesA, startsB, codesB, crossOvers):
+    """Builds the segment arrays of the recombinant that starts with parent A and switches parent at each crossover"""
+    if len(crossOvers) == 0:
+        if Instrumentation.enabled:
+            Instrumentation.count("segmentsCreated", len(startsA))
+        return startsA, codesA
+    if len(startsA) + len(startsB) <= smallSplice:
+        return spliceSegmentLists(startsA, codesA, startsB, codesB, crossOvers)
+    #number of segments of each parent starting before each crossover, and the parent of origin at the crossover
+    breaksA = searchsorted(startsA, crossOvers)
+    breaksB = searchsorted(startsB, crossOvers)
+    parents = ((startsA, codesA, append(breaksA, len(startsA)), codesA[breaksA - 1]),
+               (startsB, codesB, append(breaksB, len(startsB)), codesB[breaksB - 1]))
+    #alternating blocks: a new segment at each crossover followed by the parent's segments up to the next crossover
+    starts = [startsA[:breaksA[0]]]
+    codes = [codesA[:breaksA[0]]]
+    for index in xrange(len(crossOvers)):
+        blockStarts, blockCodes, blockBreaks, headCodes = parents[(index + 1) % 2]
+        starts += [crossOvers[index:index + 1], blockStarts[blockBreaks[index]:blockBreaks[index + 1]]]
+        codes += [headCodes[index:index + 1], blockCodes[blockBreaks[index]:blockBreaks[index + 1]]]
+    starts = concatenate(starts)
+    codes = concatenate(codes)
+    #remove redundant segments
+    keep = empty(len(codes), dtype = bool)
+    keep[0] = True
+    not_equal(codes[1:], codes[:-1], keep[1:])
+    starts, codes = starts[keep], codes[keep]
+    #new arrays that nothing else refers to, so a Chromosome can take them without a copy
+    starts.flags.writeable = False
+    codes.flags.writeable = False
+    if Instrumentation.enabled:
+        Instrumentation.count("segmentsCreated", len(starts))
+        Instrumentation.count("segmentsMerged", len(keep) - len(starts))
+    return starts, codes
+
+
+def spliceSegmentLists(startsA, codesA, startsB, codesB, crossOvers):
+    """spliceSegments on Python lists, for parents with few segments"""
+    parents = ((startsA.tolist(), codesA.tolist()), (startsB.tolist(), codesB.tolist()))
+    crossOvers = crossOvers.tolist()
+    starts = list()
+    codes = list()
+    #parent A's segments up to the first crossover, then alternating blocks: a new segment at each crossover followed by
+    #the parent's segments up to the next crossover, leaving out segments that continue the one before
+    blockStarts, blockCodes = parents[0]
+    end = bisect.bisect_left(blockStarts, crossOvers[0])
+    nSpliced = end
+    for i in xrange(end):
+        if len(codes) == 0 or blockCodes[i] != codes[-1]:
+            starts.append(blockStarts[i])
+            codes.append(blockCodes[i])
+    for index, crossOver in enumerate(crossOvers):
+        blockStarts, blockCodes = parents[(index + 1) % 2]
+        begin = bisect.bisect_left(blockStarts, crossOver)
+        if index + 1 < len(crossOvers):
+            end = bisect.bisect_left(blockStarts, crossOvers[index + 1], begin)
+        else:
+            end = len(blockStarts)
+        nSpliced += end - begin + 1
+        if len(codes) == 0 or blockCodes[begin - 1] != codes[-1]:
+            starts.append(crossOver)
+            codes.append(blockCodes[begin - 1])
+        for i in xrange(begin, end):
+            if blockCodes[i] != codes[-1]:
+                starts.append(blockStarts[i])
+                codes.append(blockCodes[i])
+    starts = array(starts, dtype = float64)
+    codes = array(codes, dtype = int32)
+    starts.flags.writeable = False
+    codes.flags.writeable = False
+    if Instrumentation.enabled:
+        Instrumentation.count("segmentsCreated", len(starts))
+        Instrumentation.count("segmentsMerged", nSpliced - len(starts))
+    return starts, codes
+
+
+def spliceSegmentTables(starts, codes, offsets, rowsA, rowsB, counts, crossOvers, fromA):
+    """Builds the recombinant segment arrays for a whole generation of meioses at once.
+       Meiosis i is between rows rowsA[i] and rowsB[i] of the parental table, has counts[i] crossovers (consecutive 
+       and sorted in crossOvers) and its product starts with parent A if fromA[i] is true.
+       Returns the starts, codes and offsets of the offspring table."""
+    counts = asarray(counts)
+    nBlocks = counts + 1
+    meiosis = repeat(arange(len(counts)), nBlocks)
+    blockIndex = arange(len(meiosis))
+    position = blockIndex - (cumsum(nBlocks) - nBlocks)[meiosis]
+    useA = (position % 2 == 0) == asarray(fromA, dtype = bool)[meiosis]
+    parent = where(useA, asarray(rowsA)[meiosis], asarray(rowsB)[meiosis])
+    
+    #segments of each parent starting before each crossover, from one search of the whole table;
+    #complex keys sort by row, then by start
+    keys = repeat(arange(len(offsets) - 1), diff(offsets)) + 1j * starts
+    crossMeiosis = repeat(arange(len(counts)), counts)
+    breaksA = searchsorted(keys, asarray(rowsA)[crossMeiosis] + 1j * crossOvers)
+    breaksB = searchsorted(keys, asarray(rowsB)[crossMeiosis] + 1j * crossOvers)
+    
+    #block k of a meiosis begins at crossover k - 1 and ends at crossover k
+    first = offsets[parent]
+    inner = position > 0
+    crossIndex = blockIndex[inner] - meiosis[inner] - 1
+    first[inner] = where(useA[inner], breaksA[crossIndex], breaksB[crossIndex])
+    last = offsets[parent + 1]
+    inner = position < counts[meiosis]
+    crossIndex = blockIndex[inner] - meiosis[inner]
+    last[inner] = where(useA[inner], breaksA[crossIndex], breaksB[crossIndex])
+    
+    #every block after the first gets a new segment at its crossover, followed by the parent's segments
+    hasHead = position > 0
+    bodyLengths = maximum(last - first, 0)
+    blockLengths = bodyLengths + hasHead
+    blockOffsets = cumsum(blockLengths) - blockLengths
+    newStarts = empty(blockLengths.sum(), dtype = float64)
+    newCodes = empty(blockLengths.sum(), dtype = int32)
+    heads = blockOffsets[hasHead]
+    newStarts[heads] = crossOvers
+    newCodes[heads] = codes[first[hasHead] - 1]
+    isBody = ones(len(newStarts), dtype = bool)
+    isBody[heads] = False
+    bodyIndex = arange(bodyLengths.sum()) + repeat(first - (cumsum(bodyLengths) - bodyLengths), bodyLengths)
+    newStarts[isBody] = starts[bodyIndex]
+    newCodes[isBody] = codes[bodyIndex]
+    
+    #remove redundant segments, keeping the first segment of every offspring
+    newOffsets = append(blockOffsets[position == 0], len(newStarts))
+    keep = ones(len(newCodes), dtype = bool)
+    keep[1:] = newCodes[1:] != newCodes[:-1]
+    keep[newOffsets[:-1]] = True
+    kept = concatenate(([0], cumsum(keep)))
+    if Instrumentation.enabled:
+        Instrumentation.count("segmentsCreated", kept[-1])
+        Instrumentation.count("segmentsMerged", len(keep) - kept[-1])
+    return newStarts[keep], newCodes[keep], kept[newOffsets]
+
+
+#Pool of live chromosomes by content hash, so that identical chromosomes can share one object (see internChromosome)
+chromosomePool = weakref.WeakValueDictionary()
+#spliceGamete interns from the meiosis threads
+chromosomePoolLock = threading.Lock()
+
+def internChromosome(chrom):
+    """Returns the pooled chromosome identical to chrom (with the same segments, length and crossover model),
+       adding chrom to the pool if there is none"""
+    with chromosomePoolLock:
+        pooled = chromosomePool.get(chrom.hash)
+        if pooled is None:
+            chromosomePool[chrom.hash] = chrom
+            return chrom
+    if pooled == chrom and pooled.cM == chrom.cM and pooled.interference == chrom.interference:
+        return pooled
+    #a hash collision, or the same segments on a chromosome of another length or model: leave the pooled one in place
+    return chrom
 
 
 class Chromosome(object):
-    """Chromosome object which contains information on parentage of segments"""
-    def __init__(self,  cM=200, name=None, segments=None, newParent=None, interference = "absent"):
+    """Chromosome object which contains information on parentage of segments.
+       Chromosomes are immutable: attributes cannot be set, the segment arrays are read-only and the content hash is
+       computed once, at creation."""
+    __slots__ = ("name", "cM", "interference", "starts", "codes", "hash", "__weakref__")
+    
+    def __init__(self,  cM=200, name=None, segments=None, newParent=None, interference = "absent", starts=None, codes=None):
         super(Chromosome, self).__init__()
-        self.name = name
-        self.cM = cM
-        self.segments = segments
-        #segments are lists of tuples where the first position is the start location, the second is the parent of origin
-        self.interference = interference
+        #segments are stored as two arrays: the start location of each segment, and the code of its parent of origin in parentLabels
+        #interference is a crossover model, or the name of one (see CrossoverModels.getCrossoverModel)
+        interference = CrossoverModels.getCrossoverModel(interference)
         
         if newParent != None:
-            if self.segments != None:
+            if segments != None or starts is not None:
                 raise ValueError, "Can't set segment information in a new parent"
-            self.segments = [(0,newParent)]
+            segments = [(0,newParent)]
         
-        if not (self.interference in ["complete", "absent"]):
-          raise ValueError, "Interference must be one of 'complete' or 'absent'."
+        if segments != None:
+            if starts is not None:
+                raise ValueError, "Specify segments either as a list of tuples or as starts and codes, not both"
+            starts = array([s[0] for s in segments], dtype = float64)
+            codes = array([internParent(s[1]) for s in segments], dtype = int32)
+        elif starts is not None:
+            if codes is None or len(starts) != len(codes):
+                raise ValueError, "starts and codes must be the same length"
+            given = starts, codes
+            starts = asarray(starts, dtype = float64)
+            codes = asarray(codes, dtype = int32)
+            #freezing must not make the caller's own arrays read-only, so writeable ones are copied
+            if starts is given[0] and starts.flags.writeable:
+                starts = starts.copy()
+            if codes is given[1] and codes.flags.writeable:
+                codes = codes.copy()
+        else:
+            codes = None
+        self.freeze(name, cM, interference, starts, codes)
+    
+    def freeze(self, name, cM, interference, starts, codes):
+        """Sets the attributes, makes the segment arrays read-only and computes the content hash"""
+        setSlot = object.__setattr__
+        setSlot(self, "name", name)
+        setSlot(self, "cM", cM)
+        setSlot(self, "interference", interference)
+        setSlot(self, "starts", starts)
+        setSlot(self, "codes", codes)
+        if starts is None:
+            setSlot(self, "hash", hash(name))
+            return
+        starts.flags.writeable = False
+        codes.flags.writeable = False
+        setSlot(self, "hash", hash((name, starts.tobytes(), codes.tobytes())))
+    
+    def __setattr__(self, attribute, value):
+        #the hash and the intern pool (see internChromosome) depend on every attribute
+        raise AttributeError, "Chromosomes are immutable; make a new Chromosome instead"
+    
+    def getSegments(self):
+        if self.starts is None:
+            return None
+        return zip(self.starts.tolist(), [parentLabels[c] for c in self.codes])
+    segments = property(fget = getSegments, doc = "List of (start, parent) tuples for each segment")
+    
+    nSegments = property(fget = lambda self: len(self.starts), doc = "Number of segments")
+    
+    def __getstate__(self):
+        #parent codes are only meaningful within a process, so pickle the labels instead
+        used, localCodes = unique(self.codes, return_inverse = True)
+        return (self.name, self.cM, self.interference, self.starts,
+                [parentLabels[c] for c in used], localCodes)
+    
+    def __setstate__(self, state):
+        name, cM, interference, starts, labels, localCodes = state
+        codes = array([internParent(p) for p in labels], dtype = int32)[localCodes]
+        #codes, and so the hash, depend on the parent table of this process
+        self.freeze(name, cM, interference, starts, codes)
+    
+    def __hash__(self):
+        return self.hash
         
     def __eq__(self, other):
       if  isinstance(other, Chromosome):
-        if self.name != other.name:
-          return False
-        if len(self.segments) != len(other.segments):
+        #interned chromosomes are identical objects, and different chromosomes almost always differ in hash
+        if self is other:
+          return True
+        if self.hash != other.hash or self.name != other.name:
           return False
-        for s1, s2 in itertools.izip(self.segments, other.segments):
-          if s1 != s2: return False
-        return True  
+        return array_equal(self.starts, other.starts) and array_equal(self.codes, other.codes)
       else: return NotImplemented
     
     def __ne__(self, other):
@@ -58,110 +321,199 @@ class Chromosome(object):
         """gets the Parental Identity for a chromosomal location"""
         if loc < 0 or loc > 1:
             raise ValueError, "Location must be in range [0,1]"
-            
-        i = 0
-        while i < len(self.segments) and self.segments[i][0] < loc :
-            i+=1
-        return self.segments[i-1][1]
+        #last segment starting before loc (the first segment for loc = 0)
+        i = searchsorted(self.starts, loc, side = "left")
+        return parentLabels[self.codes[max(i - 1, 0)]]
     
-    def getParentAtLocations(self, locs):
-        """gets the Parental Identity for a list of chromosomal locations"""
-        parents = [''] * len(locs)
-        order = [i for _,i in sorted(itertools.izip( locs, range(len(locs)) ))]
-        if locs[order[0]] < 0 or locs[order[-1]] > 1 :
+    def getCodesAtLocations(self, locs):
+        """Parent codes (see parentLabels) for an array of chromosomal locations, in any order"""
+        locs = asarray(locs, dtype = float64)
+        if locs.size > 0 and (locs.min() < 0 or locs.max() > 1):
             raise ValueError, "Locations must be in range [0,1]"
-        i = 0
-        for n in order:
-          while i < len(self.segments) and self.segments[i][0] < locs[n] :
-            i+=1
-          parents[n] = self.segments[i-1][1]
-        return parents
+        return self.codes[maximum(searchsorted(self.starts, locs, side = "left") - 1, 0)]
     
+    def getParentAtLocations(self, locs):
+        """gets the Parental Identity for a list of chromosomal locations"""
+        return [parentLabels[code] for code in self.getCodesAtLocations(locs).tolist()]
     
     def getParentAtMapLoc(self, mapLoc):
       """gets the Parental identity for a given cM position"""
       if mapLoc < 0 or mapLoc > self.cM:
         raise ValueError, "Map location must be withing the range of the chromosome."
-      loc = cM/float(self.cM)
+      loc = mapLoc/float(self.cM)
       return self.getParentAtLocation(loc)
-      
+    
+    def getCodesAtMapLocs(self, mapLocs):
+        """Parent codes for an array of cM positions, in any order"""
+        mapLocs = asarray(mapLocs, dtype = float64)
+        if mapLocs.size > 0 and (mapLocs.min() < 0 or mapLocs.max() > self.cM):
+            raise ValueError, "Map locations must be within the range of the chromosome."
+        return self.getCodesAtLocations(mapLocs / self.cM)
+    
     def getParentAtMapLocs(self, mapLocs):
-        """gets the Parental Identity for a list of chromosomal locations"""
-        parents = [''] * len(mapLocs)
-        locs = [ml/float(self.cM) for ml in mapLocs]
-        order = [i for _,i in sorted(itertools.izip( locs, range(len(locs)) ))]
-        if locs[order[0]] < 0 or locs[order[-1]] > 1 :
-            raise ValueError, "Locations must be in range [0,1]"
-        i = 0
-        for n in order:
-          while i < len(self.segments) and self.segments[i][0] < locs[n] :
-            i+=1
-          parents[n] = self.segments[i-1][1]
-        return parents
-    
-    def recombine(self, mate, interference = None):
+        """gets the Parental Identity for a list of cM positions"""
+        return [parentLabels[code] for code in self.getCodesAtMapLocs(mapLocs).tolist()]
+    
+    def recombine(self, mate, interference = None, rng = random):
+        """Pair of recombinant products with mate, drawn from rng (a RandomState or numpy.random)"""
         if self.name != mate.name:
             raise ValueError, "Chromosome names are not the same; can't recombine between them." 
+        if Instrumentation.enabled:
+          Instrumentation.count("meioses")
         if self == mate:
-          #shortcut: any recombinants would be identical anyway
-          return (Chromosome(name = self.name, cM = self.cM,  segments = self.segments), 
-                  Chromosome(name = self.name, cM = self.cM,  segments = self.segments))
+          #shortcut: any recombinants would be identical anyway (gamete() relies on this making no draws);
+          #chromosomes are immutable, so the parents themselves can be returned
+          if Instrumentation.enabled:
+            Instrumentation.count("identicalMeioses")
+          return self, mate
         
         if interference == None:
           interference = self.interference
+        crossOvers = CrossoverModels.getCrossoverModel(interference).breaks(self.cM, rng)
+        if Instrumentation.enabled:
+          Instrumentation.count("crossovers", len(crossOvers))
         
-        segments1 = list(self.segments)
-        segments2 = list(mate.segments)
-        brokenSegments1 = list()
-        brokenSegments2 = list()
+        #combine segment arrays, alternating parents at each crossover
+        starts1, codes1 = spliceSegments(self.starts, self.codes, mate.starts, mate.codes, crossOvers)
+        starts2, codes2 = spliceSegments(mate.starts, mate.codes, self.starts, self.codes, crossOvers)
         
-        if interference == "absent":
-          crossOvers = generateBreaksPoisson(self.cM)
-        elif interference == "complete":
-          crossOvers = random.uniform(size=1)
+        chr1 = internChromosome(Chromosome(name = self.name, cM = self.cM,  starts = starts1, codes = codes1, interference = self.interference))
+        chr2 = internChromosome(Chromosome(name = self.name, cM = self.cM,  starts = starts2, codes = codes2, interference = self.interference))
+        if rng.binomial(1,0.5): #randomly order xover products
+            return chr1, chr2
         else:
-          raise ValueError, "Interference setting must be one of 'absent' or 'complete'."
-        
-        for crossOver in crossOvers:
-            tempSeg = list()
-            #move segments to temp list until you get past the crossover
-            while len(segments1) > 0 and segments1[0][0] < crossOver:
-                tempSeg.append(segments1.pop(0))
-            #add in new start segment
-            segments1.insert(0, (crossOver, tempSeg[-1][1]))
-            brokenSegments1.append(tempSeg)
-            
-            tempSeg=[]
-            while len(segments2) > 0 and segments2[0][0] < crossOver:
-                tempSeg.append(segments2.pop(0))
-            segments2.insert(0, (crossOver, tempSeg[-1][1]))
-            brokenSegments2.append(tempSeg)
-        #all breakpoints done, now just add the remainder of the segments to our lists
-        brokenSegments1.append(segments1)
-        brokenSegments2.append(segments2)
-        
-        #combine breakpoint lists, alternating parental lists
-        chr1 = list()
-        chr2 = list()
-        for index, bs1 in enumerate(brokenSegments1):
-            if index % 2 == 0 : 
-                chr1 += bs1 
-                chr2 += brokenSegments2[index]
-            else:
-                chr1 += brokenSegments2[index]
-                chr2 += bs1
-        
-        #remove redundant segments
-        chr1 = [x for i,x in enumerate(chr1) if (i == 0 or chr1[i][1] != chr1[i-1][1])]
-        chr2 = [x for i,x in enumerate(chr2) if (i == 0 or chr2[i][1] != chr2[i-1][1])]
-        
-        
-        if random.binomial(1,0.5): #randomly order xover products
-            return (Chromosome(name = self.name, cM = self.cM,  segments = chr1), 
-                    Chromosome(name = self.name, cM = self.cM,  segments = chr2))
+            return chr2, chr1
+    
+    def drawGamete(self, mate, interference = None, rng = random):
+        """Random draws for the gamete of a meiosis with mate: the parent it starts with, the other parent and the crossovers.
+           Uses the same draws as recombine(), so spliceGamete of the result is recombine(mate)[0]."""
+        if self.name != mate.name:
+            raise ValueError, "Chromosome names are not the same; can't recombine between them." 
+        if Instrumentation.enabled:
+          Instrumentation.count("meioses")
+        if self == mate:
+          if Instrumentation.enabled:
+            Instrumentation.count("identicalMeioses")
+          return self, mate, empty(0)
+        if interference == None:
+          interference = self.interference
+        crossOvers = CrossoverModels.getCrossoverModel(interference).breaks(self.cM, rng)
+        if Instrumentation.enabled:
+          Instrumentation.count("crossovers", len(crossOvers))
+        if rng.binomial(1,0.5):
+            return self, mate, crossOvers
         else:
-            return (Chromosome(name = self.name, cM = self.cM,  segments = chr2), 
-                    Chromosome(name = self.name, cM = self.cM,  segments = chr1))            
+            return mate, self, crossOvers
+    
+    def gamete(self, mate, interference = None, rng = random):
+        """Single product of a meiosis with mate, without building the other recombinant"""
+        return spliceGamete(*self.drawGamete(mate, interference, rng))
+
+
+def spliceGamete(first, second, crossOvers):
+    """Recombinant of chromosomes first and second that starts with first and switches at each crossover.
+       Recombinants identical to a live chromosome are that chromosome (see internChromosome)."""
+    starts, codes = spliceSegments(first.starts, first.codes, second.starts, second.codes, crossOvers)
+    return internChromosome(Chromosome(name = first.name, cM = first.cM, starts = starts, codes = codes, interference = first.interference))
+
+
+class SegmentTable(object):
+    """Segments of one chromosome for every individual of a population, stored as flat arrays.
+       The segments of individual i are starts[offsets[i]:offsets[i+1]] and codes[offsets[i]:offsets[i+1]]."""
+    __slots__ = ("name", "cM", "interference", "starts", "codes", "offsets")
+    
+    def __init__(self, cM = 200, name = None, interference = "absent", starts = None, codes = None, offsets = None, chromosomes = None):
+        self.name = name
+        self.cM = cM
+        self.interference = CrossoverModels.getCrossoverModel(interference)
+        if chromosomes != None:
+            if starts is not None:
+                raise ValueError, "Specify segments either as a list of chromosomes or as starts, codes and offsets, not both"
+            self.name = chromosomes[0].name
+            self.cM = chromosomes[0].cM
+            self.interference = chromosomes[0].interference
+            starts = concatenate([c.starts for c in chromosomes])
+            codes = concatenate([c.codes for c in chromosomes])
+            offsets = concatenate(([0], cumsum([c.nSegments for c in chromosomes])))
+        if starts is None or codes is None or offsets is None:
+            raise ValueError, "Must specify starts, codes and offsets or a list of chromosomes"
+        self.starts = asarray(starts, dtype = float64)
+        self.codes = asarray(codes, dtype = int32)
+        self.offsets = asarray(offsets, dtype = int64)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def getChromosome(self, i):
+        """Chromosome of individual i, sharing the table's arrays"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        #read-only views, so that the chromosome shares them instead of copying
+        starts = self.starts[start:end]
+        codes = self.codes[start:end]
+        starts.flags.writeable = False
+        codes.flags.writeable = False
+        return Chromosome(name = self.name, cM = self.cM, interference = self.interference, starts = starts, codes = codes)
+    
+    def getCodesAt(self, rows, locs):
+        """Parent codes of individuals rows at locations locs (broadcast against each other), from one search of the whole table"""
+        rows = asarray(rows)
+        #complex keys sort by row, then by start; the parent at a location is the last segment starting before it
+        keys = repeat(arange(len(self)), diff(self.offsets)) + 1j * self.starts
+        index = searchsorted(keys, rows + 1j * asarray(locs, dtype = float64)) - 1
+        return self.codes[maximum(index, self.offsets[rows])]
+    
+    def getCodesAtLocations(self, locs):
+        """(locations x individuals) matrix of the parent codes at each location"""
+        locs = asarray(locs, dtype = float64)
+        if len(locs) > 0 and (locs.min() < 0 or locs.max() > 1):
+            raise ValueError, "Locations must be in range [0,1]"
+        return self.getCodesAt(arange(len(self))[newaxis, :], locs[:, newaxis])
+    
+    def identicalRows(self, rowsA, rowsB):
+        """Boolean array, true for each pair of rows rowsA[i], rowsB[i] whose segments are identical"""
+        rowsA = asarray(rowsA)
+        rowsB = asarray(rowsB)
+        lengths = diff(self.offsets)
+        candidates = nonzero(lengths[rowsA] == lengths[rowsB])[0]
+        n = lengths[rowsA[candidates]]
+        pair = repeat(arange(len(candidates)), n)
+        within = arange(n.sum()) - repeat(cumsum(n) - n, n)
+        a = self.offsets[rowsA[candidates]][pair] + within
+        b = self.offsets[rowsB[candidates]][pair] + within
+        differ = (self.starts[a] != self.starts[b]) | (self.codes[a] != self.codes[b])
+        identical = zeros(len(rowsA), dtype = bool)
+        identical[candidates] = bincount(pair, weights = differ, minlength = len(candidates)) == 0
+        return identical
+    
+    def recombine(self, rowsA, rowsB, counts, crossOvers, fromA):
+        """New table with one recombinant for each pair of rows; see spliceSegmentTables"""
+        if Instrumentation.enabled:
+            Instrumentation.count("meioses", len(rowsA))
+            Instrumentation.count("identicalMeioses", count_nonzero(self.identicalRows(rowsA, rowsB)))
+            Instrumentation.count("crossovers", len(crossOvers))
+        starts, codes, offsets = spliceSegmentTables(self.starts, self.codes, self.offsets, rowsA, rowsB, counts, crossOvers, fromA)
+        return SegmentTable(name = self.name, cM = self.cM, interference = self.interference,
+                            starts = starts, codes = codes, offsets = offsets)
+
+
+def markerRuns(table, locs):
+    """Number of the sorted marker locations locs that fall in each segment of a SegmentTable, from one search of the
+       segment starts.  As in SegmentTable.getCodesAtLocations, a marker at the start of a segment belongs to the one before."""
+    bounds = searchsorted(locs, table.starts, side = "right")
+    counts = diff(table.offsets)
+    #the first segment of each individual starts at the first marker, and its last runs to the last marker
+    bounds[table.offsets[:-1][counts > 0]] = 0
+    ends = append(bounds[1:], len(locs))
+    ends[table.offsets[1:][counts > 0] - 1] = len(locs)
+    return ends - bounds
+
+def joinTables(tables):
+    """SegmentTable with the individuals of each of a list of SegmentTables of one chromosome, in order"""
+    shifts = cumsum([0] + [len(table.starts) for table in tables[:-1]])
+    return SegmentTable(name = tables[0].name, cM = tables[0].cM, interference = tables[0].interference,
+                        starts = concatenate([table.starts for table in tables]),
+                        codes = concatenate([table.codes for table in tables]),
+                        offsets = concatenate([[0]] + [table.offsets[1:] + shift for table, shift in itertools.izip(tables, shifts)]))
 
 
         
@@ -172,4 +524,4 @@ if __name__ == '__main__':
     print newChrs[0].segments
     newChrs = newChrs[0].recombine(newChrs[1])
     print newChrs[0].segments
-    print newChrs[0].getParentAtLocation(0.5)
\ No newline at end of file
+    print newChrs[0].getParentAtLocation(0.5)
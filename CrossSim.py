@@ -3,7 +3,7 @@
 """
 CrossSim.py
 
-Simulates crosses among haploid individuals.  8 parent crosses with various crossing schemes.
+Simulates crosses among haploid or diploid founders with various crossing schemes.
 
 Created by Joshua Shapiro on 2008-10-06.
 """
@@ -11,14 +11,29 @@ from __future__ import division
 import sys
 import os
 import optparse
+import itertools
+import multiprocessing
+import json
+import cProfile
 
 
 from numpy import *
 import Crosses
 import Individual
+import Population
+import Ancestry
+import Statistics
+import CrossoverModels
+import Chromosomes
+import Instrumentation
+import Results
 
-def getOptions():
-  """Get command line options"""
+#crossing schemes among haploid and among diploid founders
+haploidSchemes = ['collab', 'random', 'bigRand']
+diploidSchemes = ['ril-sib', 'ril-self', 'backcross', 'ail']
+
+def getOptions(args = None):
+  """Get command line options, from args if given or else from sys.argv"""
   parser = optparse.OptionParser()
   parser.add_option("-r", "--replicates", 
                     action = "store", dest = "reps",
@@ -26,11 +41,12 @@ def getOptions():
                     help = "Number of simulations to run")
   parser.add_option("-s","--scheme",
                     action = "store", dest = "scheme", default = 'collab',
-                    help = "Crossing scheme. One of: 'collab' (collaborative cross), 'round' (round robin crosses), 'random' (random crossing)")
+                    help = "Crossing scheme. One of: 'collab' (collaborative cross), 'random' (random crossing), 'bigRand' (random crossing in a near infinite population), "
+                           "or among diploids 'ril-sib' and 'ril-self' (recombinant inbred lines by sib mating or selfing), 'backcross' (to founder 0, from founder 1; other founders are not used), 'ail' (advanced intercross lines)")
   parser.add_option("-g", "--generations",
                     action = "store", dest = "generations", 
                     type = "int", default = 0,
-                    help = "Number of generations fo simulate. For Collaborative cross, this is the number of additional random mating generations")
+                    help = "Number of generations fo simulate. For Collaborative cross, this is the number of additional random mating generations; for RILs, the generations of inbreeding (20 if not given); for backcrosses, the backcross generations (5 if not given)")
   parser.add_option("-n", "--nInd", 
                     action = "store", dest = "nInd", 
                     type = "int", default = None,
@@ -40,7 +56,78 @@ def getOptions():
                     action = "store", dest = "fInd", 
                     type = "int", default = 315,
                     help = "Final number of individuals to simulate.  If it is greater than the number of individuals present in the last generation, an additional round of crosses may be added")
-  (options, args) = parser.parse_args()
+  parser.add_option("--founders",
+                    action = "store", dest = "founders",
+                    type = "int", default = 8,
+                    help = "Number of founders")
+  parser.add_option("-c", "--chromosomes",
+                    action = "store", dest = "chromosomes", default = "200",
+                    help = "Comma separated lengths in cM of the chromosomes of each founder")
+  parser.add_option("--stream",
+                    action = "store_true", dest = "stream", default = False,
+                    help = "For 'bigRand', build each final individual's lineage separately and compute statistics on the stream, without holding whole generations in memory")
+  parser.add_option("--ancestry",
+                    action = "store", dest = "ancestry",
+                    type = "int", default = None,
+                    help = "Record random mating generations as an ancestry graph instead of copying segments, simplifying it every ANCESTRY generations")
+  parser.add_option("-i", "--interval",
+                    action = "store", dest = "interval",
+                    type = "float", default = 1,
+                    help = "Spacing in cM of the sites used for founder coverage statistics")
+  parser.add_option("-l", "--lowCount",
+                    action = "store", dest = "lowCount",
+                    type = "int", default = 20,
+                    help = "Founders carried by fewer than this many individuals at a site count as low frequency")
+  parser.add_option("--interference",
+                    action = "store", dest = "interference", default = "absent",
+                    help = "Crossover model. One of: 'absent', 'complete', 'gamma:NU[,P]' (gamma renewal model with shape NU and a fraction P of non-interfering crossovers), 'chisquare:M[,P]'")
+  parser.add_option("-j", "--jobs",
+                    action = "store", dest = "jobs",
+                    type = "int", default = 1,
+                    help = "Number of worker processes for running replicates in parallel")
+  parser.add_option("-t", "--threads",
+                    action = "store", dest = "threads",
+                    type = "int", default = 1,
+                    help = "Number of threads in each process for splicing the chromosomes of meioses")
+  parser.add_option("--instrument",
+                    action = "store_true", dest = "instrument", default = False,
+                    help = "Count meioses, crossovers and segments and time each generation and the statistics, writing a summary of each replicate to stderr.  With --stream the final generation is only built as the statistics read it, so the time of crossing it is counted under 'stats'")
+  parser.add_option("--profile",
+                    action = "store", dest = "profile", default = None,
+                    help = "Run the first replicate under cProfile and save its profile to this file")
+  parser.add_option("--series",
+                    action = "store", dest = "series", default = None,
+                    help = "Collect statistics after every batched generation and save them for all replicates to this file, as a compressed .npz time series")
+  parser.add_option("-o", "--output",
+                    action = "store", dest = "output", default = None,
+                    help = "Append the results of each replicate to this results directory (chunked .npz columns with an index; see Results.py) instead of printing them")
+  parser.add_option("--freqs",
+                    action = "store_true", dest = "freqs", default = False,
+                    help = "With --output, also save the founder frequencies at every site of each replicate")
+  parser.add_option("--lengths",
+                    action = "store_true", dest = "lengths", default = False,
+                    help = "With --output, also save the lengths of the unrecombined segments of each replicate")
+  parser.add_option("--seed",
+                    action = "store", dest = "seed",
+                    type = "int", default = None,
+                    help = "Random seed for the run. Each replicate is seeded from this and its replicate number, so results do not depend on the number of jobs")
+  (options, args) = parser.parse_args(args)
+  try:
+    CrossoverModels.getCrossoverModel(options.interference)
+  except ValueError, e:
+    parser.error(str(e))
+  try:
+    options.chromosomes = [float(c) for c in options.chromosomes.split(",")]
+  except ValueError:
+    parser.error("Chromosome lengths must be numbers")
+  if options.scheme not in haploidSchemes + diploidSchemes:
+    parser.error("Unknown crossing scheme '%s'" % options.scheme)
+  if options.scheme == 'collab' and not 2 <= options.founders <= 64:
+    parser.error("The collaborative cross needs 2 to 64 founders")
+  if options.scheme.startswith('ril') and (options.founders < 2 or options.founders & (options.founders - 1)):
+    parser.error("Recombinant inbred lines need a power of 2 founders")
+  if options.scheme in ('random', 'ail', 'backcross') and options.founders < 2:
+    parser.error("Random crosses, advanced intercrosses and backcrosses need at least 2 founders")
   return options
 
 class SimStats(object):
@@ -49,96 +136,189 @@ class SimStats(object):
     pass
     
 
-def main():
-  options = getOptions()
-  parentIDs = [0,1,2,3,4,5,6,7]
-  parents = [Individual.Haploid(name = p, newChr = 1) for p in parentIDs ] 
-  allStats = list()
-   
-  for i in range(0, int(options.reps)):
-    stats = SimStats()
-    if options.scheme == 'collab':
-      population = Crosses.collabCross(parents)
-      if options.generations > 0:
-        for i in range(0, options.generations - 1):
-          population =  Crosses.randomCross(population, nOffspring = options.nInd)
-        population = Crosses.randomCross(population, nOffspring = options.fInd)
+def batchPopulation(individuals, options):
+  """Population structure used for the random mating generations"""
+  population = Population.HaploidPopulation(individuals = individuals)
+  if options.ancestry:
+    population = Ancestry.AncestryPopulation(population, simplifyInterval = options.ancestry)
+  return population
+
+def runReplicate(args):
+  """Runs one replicate cross and calculates its statistics"""
+  options, rep = args
+  rng = Crosses.randomState(options.seed, rep)
+  Chromosomes.setMeiosisThreads(options.threads)
+  Instrumentation.enable(options.instrument)
+  parentIDs = range(options.founders)
+  if options.scheme in diploidSchemes:
+    parents = Population.DiploidPopulation(names = parentIDs, newChr = len(options.chromosomes), cM = options.chromosomes, interference = options.interference)
+  else:
+    parents = [Individual.Haploid(name = p, newChr = len(options.chromosomes), cM = options.chromosomes, interference = options.interference) for p in parentIDs ] 
+  if options.series != None:
+    collector = Statistics.GenerationStats(parentIDs, interval = options.interval, lowCount = options.lowCount)
+    collector.attach()
+  try:
+    with Instrumentation.timer("crossing"):
+      population = runCross(parents, options, rng)
+  finally:
+    if options.series != None:
+      collector.detach()
+  with Instrumentation.timer("stats"):
+    stats = populationStats(population, parentIDs, options)
+  if options.series != None:
+    stats.series = collector.series()
+  if options.instrument:
+    stats.instrumentation = Instrumentation.summary()
+  return stats
+
+def runCross(parents, options, rng = random):
+  """Crosses the parents with the crossing scheme of the options"""
+  if options.scheme == 'collab':
+    population = Crosses.collabCross(parents, rng = rng)
+    if options.generations > 0:
+      population = batchPopulation(population, options)
+      for i in range(0, options.generations - 1):
+        population =  Crosses.randomCross(population, nOffspring = options.nInd, rng = rng)
+      population = Crosses.randomCross(population, nOffspring = options.fInd, rng = rng)
     
-    elif options.scheme == 'random':
+  elif options.scheme == 'random':
       
-      if options.generations == 0:
-        gens = 1
-      else:
-        gens = options.generations
-      population = Crosses.abaCross(parents)
-      for i in range(0, gens - 1):
-        population = Crosses.randomCross(population, nOffspring = options.nInd)
-      population = Crosses.randomCross(population, nOffspring = options.fInd)
-    
-    elif options.scheme == 'bigRand':
-      if options.generations == 0:
-        gens = 1
-      else:
-        gens = options.generations
-      population = Crosses.randInfCross(parents, options.fInd, generations = gens)
-    #crosses done, data in population list
-    #calculate stats for each cross
-    
-    #longest unrecombined segment
-    breaks = list()
-    for ind in population:
-      breaks += [s[0] for s in ind.chromosomes[0].segments]
-    breaks.sort()
-    breaks = [x for i,x in enumerate(breaks) if (i == 0 or breaks[i] != breaks[i-1])]
-    breaks.append(1.0)
-    lastbp = 0
-    maxSeg = 0
-    segs = list()
-    for bp in breaks:
-      segLen = float(bp - lastbp)
-      lastbp = bp
-      segs.append(segLen * 200)
+    if options.generations == 0:
+      gens = 1
+    else:
+      gens = options.generations
+    population = batchPopulation(Crosses.abaCross(parents, rng = rng), options)
+    for i in range(0, gens - 1):
+      population = Crosses.randomCross(population, nOffspring = options.nInd, rng = rng)
+    population = Crosses.randomCross(population, nOffspring = options.fInd, rng = rng)
     
-    stats.medSeg = median(segs)
-    stats.meanSeg = mean(segs)
-    stats.varSeg = var(segs)
-    stats.maxSeg = max(segs)
-    
-    #proportion of genome covered for each parent
-    sites = range(0,201)
-    freqs = [[0 for _ in parents] for _ in sites]
-    for i in sites:
-      for ind in population:
-        #increment count at that parental location
-        freqs[i][ind.chromosomes[0].getParentAtLocation(float(i)/200)] += 1
+  elif options.scheme == 'bigRand':
+    if options.generations == 0:
+      gens = 1
+    else:
+      gens = options.generations
+    if options.stream:
+      population = Crosses.iterRandInfCross(parents, options.fInd, generations = gens, rng = rng)
+    else:
+      population = Crosses.randInfCross(batchPopulation(parents, options), options.fInd, generations = gens, rng = rng)
+  
+  elif options.scheme in ('ril-sib', 'ril-self'):
+    if options.generations == 0:
+      gens = 20
+    else:
+      gens = options.generations
+    population = Crosses.rilCross(parents, options.fInd, generations = gens, mating = options.scheme[4:], rng = rng)
+  
+  elif options.scheme == 'backcross':
+    if options.generations == 0:
+      gens = 5
+    else:
+      gens = options.generations
+    population = Crosses.backCross(parents, 0, 1, options.nInd or options.fInd, generations = gens, nFinal = options.fInd, rng = rng)
+  
+  elif options.scheme == 'ail':
+    if options.generations == 0:
+      gens = 1
+    else:
+      gens = options.generations
+    population = Crosses.advancedIntercross(parents, options.nInd or options.fInd, generations = gens, nFinal = options.fInd, rng = rng)
+  return population
+
+def populationStats(population, parentIDs, options):
+  """Segment length and founder coverage statistics of a crossed population, over all of its chromosomes"""
+  stats = SimStats()
+  #calculate stats in a single pass over the population, so that it may be a stream
+  chromosomes = None
+  for tables in Statistics.populationTables(population):
+    if chromosomes == None:
+      chromosomes = tables
+      breaks = [Statistics.breakpoints([]) for table in tables]
+      freqs = [0 for table in tables]
+    breaks = [Statistics.breakpoints([chrBreaks, table.starts]) for table, chrBreaks in itertools.izip(tables, breaks)]
+    freqs = [chrFreqs + Statistics.founderFrequencies(table, parentIDs, interval = options.interval)
+             for table, chrFreqs in itertools.izip(tables, freqs)]
     
-    missingSegment = 0
-    anyMissing = 0
-    lowSegment = 0
-    anyLow = 0
-    for site in freqs:
-      hasMissing = 0
-      hasLow = 0
-      for parent in site:  
-        if parent == 0:
-          missingSegment += 1
-          hasMissing = 1
-        if parent < 20:
-          lowSegment += 1
-          hasLow = 1
-      anyMissing += hasMissing
-      anyLow += hasLow
-        
-    stats.missing = missingSegment/len(freqs) * len(parents)
-    stats.low = lowSegment/len(freqs) * len (parents)
-    stats.anyMissing = anyMissing/len(freqs)
-    stats.anyLow = anyLow/len(freqs)
+  #unrecombined segments, genome wide
+  genome = Statistics.segmentStats(chromosomes, breaks)["genome"]
+  segments = genome["stats"]
+  stats.medSeg = segments["median"]
+  stats.meanSeg = segments["mean"]
+  stats.varSeg = segments["var"]
+  stats.maxSeg = segments["max"]
     
-    allStats.append(stats)
+  #proportion of genome covered for each parent
+  freqs = concatenate(freqs)
+  for name, value in Statistics.coverageStats(freqs, lowCount = options.lowCount).items():
+    setattr(stats, name, value)
+  #arrays are only kept when they are saved, as they are sent back from worker processes
+  if options.output != None and options.freqs:
+    stats.freqs = freqs
+  if options.output != None and options.lengths:
+    stats.lengths = genome["lengths"]
+  return stats
+
+#scalar statistics saved for each replicate, by their SimStats attribute
+statColumns = ["medSeg", "meanSeg", "varSeg", "maxSeg", "anyMissing", "anyLow", "missing", "low"]
+
+def resultsRow(stats, rep, options):
+  """Columns of a replicate's results for a Results.ResultsWriter; rep numbers the replicate among all those in the results"""
+  row = dict((name, getattr(stats, name)) for name in statColumns)
+  row["replicate"] = rep
+  row["seed"] = options.seed
+  if options.freqs:
+    row["freqs"] = stats.freqs
+  if options.lengths:
+    row["lengths"] = stats.lengths
+  return row
+
+
+def main():
+  options = getOptions()
+  if options.seed == None:
+    options.seed = random.randint(0, 2**31 - 1)
+    print >> sys.stderr, "Seed: %d" % options.seed
+  replicates = [(options, rep) for rep in range(0, int(options.reps))]
+  profiled = list()
+  profiledReplicate = None
+  if options.profile != None and len(replicates) > 0:
+    profiledReplicate = replicates.pop(0)
+  #fork the workers first, so that they inherit none of the thread pool or instrumentation of the profiled replicate
+  if options.jobs > 1:
+    pool = multiprocessing.Pool(options.jobs)
+    workerStats = pool.imap(runReplicate, replicates)
+  else:
+    workerStats = itertools.imap(runReplicate, replicates)
+  if profiledReplicate != None:
+    profiler = cProfile.Profile()
+    profiled.append(profiler.runcall(runReplicate, profiledReplicate))
+    profiler.dump_stats(options.profile)
+  allStats = itertools.chain(profiled, workerStats)
   
-  print "median\tmean\tvar\tmax\tFracMissing\tFracLowFreq\ttotFracMissing\ttotFracLow" 
-  for stat in allStats:
-    print "%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f" % (stat.medSeg, stat.meanSeg, stat.varSeg,  stat.maxSeg, stat.anyMissing, stat.anyLow, stat.missing, stat.low)     
+  #results come back in replicate order, and are printed as soon as they are ready
+  series = list()
+  if options.output != None:
+    writer = Results.ResultsWriter(options.output)
+    #replicates appended to earlier results are numbered after them
+    firstReplicate = writer.index["replicates"]
+  else:
+    print "median\tmean\tvar\tmax\tFracMissing\tFracLowFreq\ttotFracMissing\ttotFracLow" 
+  for rep, stat in enumerate(allStats):
+    if options.output != None:
+      writer.write(resultsRow(stat, firstReplicate + rep, options))
+    else:
+      print "%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f" % (stat.medSeg, stat.meanSeg, stat.varSeg,  stat.maxSeg, stat.anyMissing, stat.anyLow, stat.missing, stat.low)     
+      sys.stdout.flush()
+    if options.instrument:
+      print >> sys.stderr, "replicate %d\t%s" % (rep, json.dumps(stat.instrumentation, sort_keys = True))
+    if options.series != None:
+      series.append(stat.series)
+  if options.output != None:
+    writer.close()
+  if options.series != None:
+    Statistics.saveSeries(options.series, series)
+  if options.jobs > 1:
+    pool.close()
+    pool.join()
 
 if __name__ == '__main__':
   main()
@@ -10,74 +10,240 @@ import itertools
 
 from numpy import *
 import Individual
+import Population
+import Ancestry
+import Instrumentation
 
-def randomCross(population, nOffspring = None):
+#population structures that produce a whole generation from arrays of parent rows
+batchedPopulations = (Population.HaploidPopulation, Population.DiploidPopulation, Ancestry.AncestryPopulation)
+
+#All crosses draw from rng, a RandomState, or by default the global state of the numpy.random module.
+#A numpy.random.Generator (numpy 1.17 and later) can be used by wrapping it in a GeneratorState.
+def randomState(seed, stream):
+    """Independent RandomState for stream number stream (a replicate or worker) of a run started from seed"""
+    return random.RandomState([seed, stream])
+
+class GeneratorState(object):
+    """RandomState interface to a numpy.random.Generator, which names randint integers; the other draws the crosses
+       use (uniform, poisson, binomial and gamma) are passed through"""
+    def __init__(self, generator):
+        self.generator = generator
+
+    def randint(self, low, high = None, size = None, dtype = int64):
+        return self.generator.integers(low, high, size = size, dtype = dtype)
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+def spawnRandomStates(seed, n):
+    """Independent RandomStates for n replicates or workers of a run started from seed"""
+    return [randomState(seed, stream) for stream in range(n)]
+
+def randomCross(population, nOffspring = None, rng = random):
+    """Random mating; a HaploidPopulation or AncestryPopulation produces the whole generation in one batch"""
     if nOffspring == None:
         nOffspring = len(population)
-    r1 = random.randint(0, len(population), size = nOffspring)
-    r2 = random.randint(0, len(population), size = nOffspring)
-    newPop = [ population[a].mate(population[b]) for a,b in itertools.izip(r1, r2) ]
-    return newPop
+    r1 = rng.randint(0, len(population), size = nOffspring)
+    r2 = rng.randint(0, len(population), size = nOffspring)
+    return mateRows(population, r1, r2, rng)
 
 
-def collabCross(population, reciprocal = False):
-    """Collaborative cross scheme.  Optimized for 2^n individuals"""
+def disjointPairs(masks, reciprocal = False, chunkSize = 2**22):
+    """Pairs of rows (a, b) whose founder bitmasks share no founders, with a < b unless reciprocal, in row-major order.
+       All pairs are tested with one bitwise AND per block of rows, each block covering about chunkSize pairs."""
+    n = len(masks)
+    blockRows = max(1, chunkSize // max(n, 1))
+    rowsA = list()
+    rowsB = list()
+    for first in xrange(0, n, blockRows):
+        block = arange(first, min(first + blockRows, n))
+        valid = (masks[block, newaxis] & masks[newaxis, :]) == 0
+        if not reciprocal:
+            valid &= block[:, newaxis] < arange(n)[newaxis, :]
+        a, b = nonzero(valid)
+        rowsA.append(block[a])
+        rowsB.append(b)
+    return concatenate(rowsA), concatenate(rowsB)
+
+def collabCross(population, reciprocal = False, progress = None, rng = random):
+    """Collaborative cross scheme.  Optimized for 2^n individuals.
+       Founders are kept as bitmasks, so pairs without shared founders are found with vectorized bitwise ANDs, and
+       each round is mated as one batch.  Returns the kind of population given, its individuals named by their index
+       with their founders' names (rows, if any founder is unnamed) as parents.  progress, if given, is called with
+       the round number and the number of individuals at the start of each round after the first."""
+    if len(population) > 64:
+        raise ValueError, "The collaborative cross is limited to 64 founders"
+    batched = isinstance(population, batchedPopulations)
+    if batched:
+        names = list(population.names)
+    else:
+        names = [ind.name for ind in population]
+        if len(population) > 0 and isinstance(population[0], Individual.Haploid) and population[0].nChr > 0:
+            population = Population.HaploidPopulation(individuals = population)
+    if None in names:
+        #unnamed individuals, such as the offspring of mate(), are known by their row instead
+        names = range(len(names))
     #first cross
-    C1 = list()
-    for ind1 in population:
-        for ind2 in population:
-            if (reciprocal and ind1 != ind2) or ind1.name < ind2.name:
-                newInd = ind1.mate(ind2)
-                newInd.name = len(C1)
-                newInd.parents = (ind1.name, ind2.name)
-                C1.append(newInd)
+    pairs = [(a, b) for a in range(len(names)) for b in range(len(names))
+             if (reciprocal and a != b) or names[a] < names[b]]
+    rowsA = array([a for a, b in pairs], dtype = int64)
+    rowsB = array([b for a, b in pairs], dtype = int64)
+    founders = concatenate((rowsA[:, newaxis], rowsB[:, newaxis]), axis = 1)
+    masks = (uint64(1) << rowsA.astype(uint64)) | (uint64(1) << rowsB.astype(uint64))
+    C1 = mateRows(population, rowsA, rowsB, rng)
     #remaining crosses
-    while len(C1[0].parents) <= len(population)/2 :
-        C2 = list()
-        print len(C1)
-        for ind1 in C1:
-            for ind2 in C1:
-                if (reciprocal and ind1 != ind2) or ind1.name < ind2.name:
-                    #check for shared parents
-                    share = False
-                    for par in ind1.parents:
-                        if par in ind2.parents:
-                            share = True
-                            break
-                    if not share and (reciprocal or ind1.name < ind2.name):
-                        newInd = ind1.mate(ind2)
-                        newInd.name = len(C2)
-                        newInd.parents = ind1.parents + ind2.parents
-                        C2.append(newInd)
-        C1 = list(C2)
-
-    return(C2)
-
-def rrCross(population, reciprocal = False):
+    rounds = 1
+    while founders.shape[1] <= len(names)/2 :
+        rounds += 1
+        if progress != None:
+            progress(rounds, len(masks))
+        rowsA, rowsB = disjointPairs(masks, reciprocal)
+        founders = concatenate((founders[rowsA], founders[rowsB]), axis = 1)
+        masks = masks[rowsA] | masks[rowsB]
+        C1 = mateRows(C1, rowsA, rowsB, rng)
+
+    parents = [tuple(names[f] for f in row) for row in founders.tolist()]
+    if batched:
+        C1.names = range(len(C1))
+        C1.parents = parents
+        return C1
+    if isinstance(C1, Population.HaploidPopulation):
+        C1 = C1.toIndividuals()
+    for i, ind in enumerate(C1):
+        ind.name = i
+        ind.parents = parents[i]
+    return C1
+
+def mateRows(population, rowsA, rowsB, rng = random):
+    """One offspring from each pair of rows rowsA[i] x rowsB[i], in one batch for batched populations"""
+    with Instrumentation.timer("generation"):
+        if isinstance(population, batchedPopulations):
+            return population.mate(rowsA, rowsB, rng)
+        return [population[a].mate(population[b], rng = rng) for a, b in itertools.izip(rowsA, rowsB)]
+
+def rrCross(population, reciprocal = False, rng = random):
     """Round robin cross for a population of individuals"""
     shiftedPop = list(population)
     shiftedPop.insert(0, shiftedPop.pop())
-    offspring = [a.mate(b) for a,b in itertools.izip(population, shiftedPop)]
-    if reciprocal:
-        offspring += [b.mate(a) for a,b in itertools.izip(population, shiftedPop)]
+    with Instrumentation.timer("generation"):
+        offspring = [a.mate(b, rng = rng) for a,b in itertools.izip(population, shiftedPop)]
+        if reciprocal:
+            offspring += [b.mate(a, rng = rng) for a,b in itertools.izip(population, shiftedPop)]
     return offspring
 
-def abaCross(population, reciprocal = False):
+def abaCross(population, reciprocal = False, rng = random):
     """All by All crossing scheme for a population"""
-    if reciprocal:
-        offspring = [a.mate(b) for a in population for b in population if a != b]
-    else:
-        offspring = [a.mate(b) for a in population for b in population if a.name < b.name]
+    with Instrumentation.timer("generation"):
+        if reciprocal:
+            offspring = [a.mate(b, rng = rng) for a in population for b in population if a != b]
+        else:
+            offspring = [a.mate(b, rng = rng) for a in population for b in population if a.name < b.name]
+    return offspring
+
+def diploidPopulation(population):
+    """DiploidPopulation of a list of diploids; a DiploidPopulation is returned as it is"""
+    if isinstance(population, Population.DiploidPopulation):
+        return population
+    return Population.DiploidPopulation(individuals = population)
+
+def distinctPairs(n, size, rng = random):
+    """size random pairs of different rows among n"""
+    rowsA = rng.randint(0, n, size = size)
+    return rowsA, (rowsA + rng.randint(1, n, size = size)) % n
+
+def funnelCross(population, nLines, perLine = 1, rng = random):
+    """Funnel crosses of diploid founders, one for each of nLines lines: the founders, in a random order for each line, are
+       crossed in pairs, then their offspring in pairs, until the last cross of each line, which makes perLine offspring.
+       The number of founders must be a power of 2.  Returns a DiploidPopulation with the offspring of each line together,
+       named by their line, with the founder names of each line in funnel order as their parents."""
+    population = diploidPopulation(population)
+    founders = population.names
+    nFounders = len(population)
+    if nFounders < 2 or nFounders & (nFounders - 1):
+        raise ValueError, "Funnel crosses need a power of 2 founders"
+    order = argsort(rng.uniform(size = (nLines, nFounders)), axis = 1)
+    #the crosses of all lines are made together, each generation's offspring kept in line order
+    rows = order.ravel()
+    rowsA, rowsB = rows[0::2], rows[1::2]
+    while len(rowsA) > nLines:
+        population = mateRows(population, rowsA, rowsB, rng)
+        rowsA, rowsB = arange(0, len(population), 2), arange(1, len(population), 2)
+    lines = mateRows(population, repeat(rowsA, perLine), repeat(rowsB, perLine), rng)
+    lines.names = repeat(arange(nLines), perLine).tolist()
+    lines.parents = [tuple(founders[f] for f in line) for line in order.tolist() for _ in range(perLine)]
+    return lines
+
+def rilCross(population, nLines, generations = 20, mating = "sib", rng = random):
+    """Recombinant inbred lines: a funnel cross of the diploid founders for each line (see funnelCross), followed by
+       generations of sib mating (mating = "sib") or selfing ("self") within each line.  Returns a DiploidPopulation
+       with one individual of each line, named by line, with the founders of its funnel as parents."""
+    if mating not in ("sib", "self"):
+        raise ValueError, "Inbreeding must be by 'sib' mating or 'self'ing"
+    #sib mated lines are kept as a pair of siblings until the last generation
+    perLine = 2 if mating == "sib" and generations > 0 else 1
+    lines = funnelCross(population, nLines, perLine, rng)
+    parents = lines.parents[::perLine]
+    first = arange(nLines) * perLine
+    for generation in range(generations):
+        offspring = perLine if generation < generations - 1 else 1
+        lines = mateRows(lines, repeat(first, offspring), repeat(first + perLine - 1, offspring), rng)
+    lines.names = range(nLines)
+    lines.parents = parents
+    return lines
+
+def backCross(population, recurrent, donor, nOffspring, generations = 1, nFinal = None, rng = random):
+    """Backcross of diploid founders: F1s of the founders recurrent x donor (given as indices in the population) are
+       crossed to the recurrent parent, and each later generation is crossed to it again, with nOffspring individuals in
+       each generation but the last, which has nFinal (by default nOffspring).  Returns the F1s if generations is 0."""
+    population = diploidPopulation(population)
+    if nFinal == None:
+        nFinal = nOffspring
+    size = nOffspring if generations > 0 else nFinal
+    offspring = mateRows(population, repeat(recurrent, size), repeat(donor, size), rng)
+    #the recurrent parent alone, which follows each generation in the population it is mated in
+    recurrentParent = diploidPopulation([population[recurrent]])
+    for generation in range(generations):
+        size = nOffspring if generation < generations - 1 else nFinal
+        joined = Population.joinPopulations([offspring, recurrentParent])
+        offspring = mateRows(joined, rng.randint(0, len(offspring), size = size), repeat(len(offspring), size), rng)
+    offspring.names = range(len(offspring))
     return offspring
 
-def randInfCross(population, nOffspring, generations):
+def advancedIntercross(population, nOffspring, generations, nFinal = None, rng = random):
+    """Advanced intercross lines: F1s from random pairs of different diploid founders, intercrossed by random mating
+       between different individuals for generations more generations (the F2 is generation 1).  Every generation has
+       nOffspring individuals but the last, which has nFinal (by default nOffspring)."""
+    population = diploidPopulation(population)
+    if nFinal == None:
+        nFinal = nOffspring
+    for generation in range(generations + 1):
+        size = nOffspring if generation < generations else nFinal
+        rowsA, rowsB = distinctPairs(len(population), size, rng)
+        population = mateRows(population, rowsA, rowsB, rng)
+    population.names = range(len(population))
+    return population
+
+def randInfCross(population, nOffspring, generations, rng = random):
   """Random cross for near infinite population sizes: all segregants are independent at every generation"""
   gen1Size = nOffspring * (2 ** (generations -1))
-  offspring = randomCross(population, nOffspring = gen1Size)
+  offspring = randomCross(population, nOffspring = gen1Size, rng = rng)
   for _ in range(0, generations - 1):
-    offspring = [offspring[i].mate(offspring[i + 1]) for i in range(0, len(offspring), 2)]
+    offspring = mateRows(offspring, arange(0, len(offspring), 2), arange(1, len(offspring), 2), rng)
   return offspring
 
+def randInfLineage(population, generations, rng = random):
+  """One final individual of randInfCross, built depth first so that at most one individual per generation is held at a time"""
+  if generations <= 1:
+    a, b = rng.randint(0, len(population), size = 2)
+    return population[a].mate(population[b], rng = rng)
+  first = randInfLineage(population, generations - 1, rng)
+  return first.mate(randInfLineage(population, generations - 1, rng), rng = rng)
+
+def iterRandInfCross(population, nOffspring, generations, rng = random):
+  """Streaming version of randInfCross: yields the final individuals one at a time, each from its own lineage"""
+  for _ in xrange(nOffspring):
+    yield randInfLineage(population, generations, rng)
+
 if __name__ == '__main__':
     myPop = [Individual.Haploid(name = x, newChr = 2) for x in ["a","b","c","d","e","f","g", "h"] ] 
     nextGen = randomCross(myPop, nOffspring = 10)
@@ -88,8 +254,10 @@ if __name__ == '__main__':
         for chr in ind.chromosomes:
             print "Chr %s: %s" % (chr.name, chr.segments)
     
-    myPop = [Individual.Haploid(name = x, newChr = 0) for x in range(16) ] 
-    ccr = collabCross(myPop)
+    myPop = [Individual.Haploid(name = x, newChr = 2) for x in range(8) ] 
+    def progress(round, nInd):
+        print "Round %d: %d individuals" % (round, nInd)
+    ccr = collabCross(myPop, progress = progress)
     print "Collaborative Cross: NInd = %d" % len(ccr)
     for i in range(10):
         print ccr[i].parents
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CrossoverModels.py
+
+Crossover models, which place the crossovers of many meioses of a chromosome at once.
+Models are registered by name so that they can be chosen with strings such as "absent",
+"complete", "gamma:4.3" or "chisquare:4,0.1".
+"""
+from __future__ import division
+import inspect
+
+from numpy import *
+
+
+def generateBreaksPoisson(cM = 200, rng = random):
+    breaks = rng.uniform(size = rng.poisson(cM/100.0))
+    breaks.sort()
+    return breaks
+
+def sortWithinMeioses(counts, positions):
+    """Sorts positions within each meiosis, where meiosis i owns the next counts[i] positions"""
+    return positions[lexsort((positions, repeat(arange(len(counts)), counts)))]
+
+
+class CrossoverModel(object):
+    """Base class for crossover models.  Subclasses implement sample()."""
+    name = None
+
+    def sample(self, cM, n, rng = random):
+        """Crossovers for n meioses of a chromosome cM long, drawn from rng (a RandomState or numpy.random).
+           Returns the number of crossovers in each meiosis and their positions, as fractions of the chromosome,
+           consecutive and sorted within each meiosis."""
+        raise NotImplementedError
+
+    def breaks(self, cM, rng = random):
+        """Sorted crossover positions for a single meiosis"""
+        return self.sample(cM, 1, rng)[1]
+
+    def getParameters(self):
+        return []
+
+    def __str__(self):
+        parameters = self.getParameters()
+        if len(parameters) == 0:
+            return self.name
+        return "%s:%s" % (self.name, ",".join(repr(p) for p in parameters))
+
+    def __eq__(self, other):
+        if isinstance(other, basestring):
+            try:
+                other = getCrossoverModel(other)
+            except ValueError:
+                return False
+        return type(self) == type(other) and self.getParameters() == other.getParameters()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class NoInterference(CrossoverModel):
+    """Crossovers placed independently: a Poisson number with mean cM/100, uniformly along the chromosome"""
+    name = "absent"
+
+    def sample(self, cM, n, rng = random):
+        counts = rng.poisson(cM/100.0, size = n)
+        return counts, sortWithinMeioses(counts, rng.uniform(size = counts.sum()))
+
+    def breaks(self, cM, rng = random):
+        return generateBreaksPoisson(cM, rng)
+
+
+class CompleteInterference(CrossoverModel):
+    """Exactly one crossover per meiosis, uniformly along the chromosome"""
+    name = "complete"
+
+    def sample(self, cM, n, rng = random):
+        return ones(n, dtype = int), rng.uniform(size = n)
+
+    def breaks(self, cM, rng = random):
+        return rng.uniform(size = 1)
+
+
+class GammaInterference(CrossoverModel):
+    """Stationary gamma renewal model of chiasmata with shape nu, each resolved into a crossover on the sampled chromatid
+       with probability 1/2.  With p > 0 it is the two-pathway model of Housworth and Stahl: a fraction p of crossovers
+       come from a second, non-interfering pathway.  nu = 1, or p = 1, is the same as no interference."""
+    name = "gamma"
+
+    def __init__(self, nu, p = 0):
+        if nu <= 0:
+            raise ValueError, "Gamma interference parameter nu must be positive."
+        if p < 0 or p > 1:
+            raise ValueError, "Proportion of non-interfering crossovers must be in range [0,1]"
+        self.nu = float(nu)
+        self.p = float(p)
+
+    def getParameters(self):
+        if self.p:
+            return [self.nu, self.p]
+        return [self.nu]
+
+    def sampleChiasmata(self, length, n, rng = random):
+        """Chiasma positions (in Morgans) in [0, length) for n meioses, from the stationary renewal process of the interfering pathway"""
+        scale = 1 / (2 * self.nu * (1 - self.p))
+        #the origin falls in a length-biased interval, so the first chiasma is a uniform fraction of a Gamma(nu + 1) gap
+        columns = int(ceil(2 * (1 - self.p) * length + 4 * sqrt(2 * length + 1) + 2))
+        gaps = rng.gamma(self.nu, scale, size = (n, columns))
+        gaps[:, 0] = rng.uniform(size = n) * rng.gamma(self.nu + 1, scale, size = n)
+        points = cumsum(gaps, axis = 1)
+        #extend the few meioses that have not yet passed the end of the chromosome
+        short = nonzero(points[:, -1] < length)[0]
+        while len(short) > 0:
+            more = points[short, -1][:, newaxis] + cumsum(rng.gamma(self.nu, scale, size = (len(short), columns)), axis = 1)
+            extended = empty((n, more.shape[1]))
+            extended.fill(inf)
+            extended[short] = more
+            points = concatenate((points, extended), axis = 1)
+            short = short[more[:, -1] < length]
+        #each chiasma involves the sampled chromatid with probability 1/2
+        kept = (points < length) & (rng.uniform(size = points.shape) < 0.5)
+        return kept.sum(axis = 1), points[kept]
+
+    def sample(self, cM, n, rng = random):
+        length = cM / 100.0
+        if self.p < 1:
+            counts, positions = self.sampleChiasmata(length, n, rng)
+        else:
+            counts, positions = zeros(n, dtype = int), zeros(0)
+        if self.p > 0:
+            extraCounts = rng.poisson(self.p * length, size = n)
+            extra = rng.uniform(0, length, size = extraCounts.sum())
+            positions = concatenate((positions, extra))
+            meiosis = concatenate((repeat(arange(n), counts), repeat(arange(n), extraCounts)))
+            positions = positions[lexsort((positions, meiosis))]
+            counts = counts + extraCounts
+        return counts, positions / length
+
+
+class ChiSquareInterference(GammaInterference):
+    """Chi-square model: chiasmata are every (m+1)th point of a Poisson process, the gamma model with integer nu = m + 1"""
+    name = "chisquare"
+
+    def __init__(self, m, p = 0):
+        if m < 0 or m != int(m):
+            raise ValueError, "Chi-square interference parameter m must be a non-negative integer."
+        self.m = int(m)
+        super(ChiSquareInterference, self).__init__(self.m + 1, p)
+
+    def getParameters(self):
+        if self.p:
+            return [self.m, self.p]
+        return [self.m]
+
+
+crossoverModels = dict()
+
+def registerCrossoverModel(model):
+    """Makes a CrossoverModel subclass available to getCrossoverModel under its name"""
+    crossoverModels[model.name] = model
+
+for model in [NoInterference, CompleteInterference, GammaInterference, ChiSquareInterference]:
+    registerCrossoverModel(model)
+
+def getCrossoverModel(spec):
+    """Crossover model for spec, which is either a CrossoverModel or a string: a registered model name, optionally
+       followed by a colon and comma separated parameters, as in 'gamma:4.3' or 'chisquare:4,0.1'"""
+    if isinstance(spec, CrossoverModel):
+        return spec
+    if not isinstance(spec, basestring):
+        raise TypeError, "Crossover model must be a CrossoverModel or a string"
+    name, _, parameters = spec.partition(":")
+    if name not in crossoverModels:
+        raise ValueError, "Interference must be one of %s." % ", ".join("'%s'" % n for n in sorted(crossoverModels))
+    parameters = [float(p) for p in parameters.split(",") if p.strip()]
+    model = crossoverModels[name]
+    if model.__init__ is object.__init__:
+        required = allowed = 0
+    else:
+        arguments, _, _, defaults = inspect.getargspec(model.__init__)
+        allowed = len(arguments) - 1
+        required = allowed - len(defaults or ())
+    if not required <= len(parameters) <= allowed:
+        if required == allowed:
+            expected = "%d" % required
+        else:
+            expected = "%d to %d" % (required, allowed)
+        raise ValueError, "Crossover model '%s' takes %s parameters, not %d." % (name, expected, len(parameters))
+    return model(*parameters)
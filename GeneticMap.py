@@ -8,61 +8,259 @@ Created by Joshua Shapiro on 2008-10-02.
 from __future__ import division
 import sys
 import os
+import operator
+import itertools
+import json
+
+from numpy import *
 
 class GeneticMap(object):
-  """Defines a relationship between the physical and genetic maps for each marker position"""
-  def __init__(self, markers = [], mapLength = None, physLength = None):
-    self.markers = list(markers)
-    if len(self.markers) > 0:
-      chrom = self.markers[0].chrom
-    for m in self.markers:
-      if m.chrom != chrom:
-        raise ValueError, "All markers in a chromosome map must be on the same chromosome"
-    self.markers.sort(key = operator.attrgetter("cM"))
-    if mapLength:
-      self.mapLength = mapLength
-    elif len(self.markers) > 0:
-      mapLength = self.markers[-1].cM
+  """Defines a relationship between the physical and genetic maps for each marker position.
+     Markers are stored as arrays of names, cM and bp positions sorted by cM (missing bp positions are nan),
+     with a dictionary from marker name to index.  A map is built from a list of Markers, or from the arrays
+     of a single chromosome given as chrom, names, cM and bp."""
+  def __init__(self, markers = [], mapLength = None, physLength = None, chrom = None, names = None, cM = None, bp = None, presorted = False):
+    markers = list(markers)
+    if len(markers) > 0:
+      if names is not None:
+        raise ValueError, "Must specify only one of either a list of markers or the marker arrays."
+      chrom = markers[0].chrom
+      for m in markers:
+        if m.chrom != chrom:
+          raise ValueError, "All markers in a chromosome map must be on the same chromosome"
+      names = [m.name for m in markers]
+      cM = [m.cM for m in markers]
+      bp = [m.bp for m in markers]
+    self.chrom = chrom
+    self.names = array([], dtype = object)
+    self.cM = array([], dtype = float64)
+    self.bp = array([], dtype = float64)
+    self._index = dict()
+    if names is not None:
+      self.setMarkers(names, cM, bp, presorted = presorted)
+    self.mapLength = mapLength
+    self.physLength = physLength
+  
+  def setMarkers(self, names, cM, bp = None, presorted = False):
+    """Replaces the markers with the given arrays, sorting them by map position unless they are presorted"""
+    names = asarray(names, dtype = object)
+    cM = asarray(cM, dtype = float64)
+    if bp is None:
+      bp = empty(len(cM))
+      bp.fill(nan)
     else:
-      pass
-    if physLength:
-      self.physLength = physLength
-    elif len(self.markers) > 0:
-      physLength = self.markers[-1].bp
+      bp = array([nan if b is None else b for b in bp] if isinstance(bp, list) else bp, dtype = float64)
+    if not (len(names) == len(cM) == len(bp)):
+      raise ValueError, "Marker names and positions must have the same length"
+    if presorted:
+      if any(cM[1:] < cM[:-1]):
+        raise ValueError, "Presorted markers must be in order of map position"
+      self.names, self.cM, self.bp = names, cM, bp
     else:
-      pass
+      order = lexsort((bp, cM))
+      self.names, self.cM, self.bp = names[order], cM[order], bp[order]
+    self._index = None
+    #physical positions in order, for physical range queries and interpolation
+    self.bpOrder = argsort(self.bp, kind = "mergesort")
+    self.bpOrder = self.bpOrder[~isnan(self.bp[self.bpOrder])]
+    self.sortedBp = self.bp[self.bpOrder]
+  
+  def getMapLength(self):
+    if self._mapLength != None:
+      return self._mapLength
+    if len(self.cM) > 0:
+      return self.cM[-1]
+    return None
+  def setMapLength(self, mapLength):
+    self._mapLength = mapLength
+  mapLength = property(fget = getMapLength, fset = setMapLength, doc = "Length of the chromosome in cM, by default the position of the last marker")
+  
+  def getPhysLength(self):
+    if self._physLength != None:
+      return self._physLength
+    if len(self.sortedBp) > 0:
+      return self.sortedBp[-1]
+    return None
+  def setPhysLength(self, physLength):
+    self._physLength = physLength
+  physLength = property(fget = getPhysLength, fset = setPhysLength, doc = "Length of the chromosome in bp, by default the position of the last marker")
+  
+  def getIndex(self):
+    if self._index == None:
+      self._index = dict(itertools.izip(self.names.tolist(), itertools.count()))
+      if len(self._index) != len(self.names):
+        raise ValueError, "Marker names in a chromosome map must be unique"
+    return self._index
+  index = property(fget = getIndex, doc = "Dictionary from marker name to index, built on the first lookup by name")
   
-  nMarkers = property(fget = lambda self: len(self.markers), doc= "Number of markers in the map")
-  markerNames = property (fget = lambda self: [m.name for m in self.markers], doc = "List of the marker names") 
+  nMarkers = property(fget = lambda self: len(self.names), doc= "Number of markers in the map")
+  markerNames = property (fget = lambda self: self.names.tolist(), doc = "List of the marker names") 
+  markers = property(fget = lambda self: self.getMarkers(), doc = "List of Marker objects, built from the arrays when requested")
+  
+  def getMarkers(self, indices = None):
+    """Marker objects for the markers at indices (all markers by default)"""
+    if indices is None:
+      indices = xrange(self.nMarkers)
+    return [Marker(self.names[i], self.chrom, self.cM[i], None if isnan(self.bp[i]) else self.bp[i]) for i in indices]
   
   def addMarkers(self, markers):
     """Adds a marker to the chromosomal map"""
     for marker in markers:
-      if marker.chrom != self.markers[0].chrom:
+      if self.chrom == None:
+        self.chrom = marker.chrom
+      if marker.chrom != self.chrom:
         raise ValueError, "All markers in a chromosome map must be on the same chromosome"
-    self.markers += markers
-    self.markers.sort(key = operator.attrgetter("cM"))
+    self.setMarkers(concatenate((self.names, array([m.name for m in markers], dtype = object))),
+                    concatenate((self.cM, [m.cM for m in markers])),
+                    concatenate((self.bp, [nan if m.bp is None else m.bp for m in markers])))
   
   def getMarkerMapPosition(self, marker):
     """Get the map postion in centimorgans of the named marker"""
-    if marker in self.markerNames:
-      return self.markers[self.markerNames.index(marker)].cM
+    if marker in self.index:
+      return self.cM[self.index[marker]]
     else:
       return None
   
   def getMarkerPhysPosition(self, marker):
-    """Get the map postion in centimorgans of the named marker"""
-    if marker in self.markerNames:
-      return self.markers[self.markerNames.index(marker)].bp
+    """Get the physical position in bp of the named marker"""
+    if marker in self.index and not isnan(self.bp[self.index[marker]]):
+      return self.bp[self.index[marker]]
     else:
       return None
   
+  def getIndicesByMapRange(self, start, end):
+    """Indices of the markers with map positions in the range [start, end]"""
+    return arange(searchsorted(self.cM, start, side = "left"), searchsorted(self.cM, end, side = "right"))
+  
+  def getIndicesByPhysicalRange(self, start, end):
+    """Indices, in map order, of the markers with physical positions in the range [start, end]"""
+    return sort(self.bpOrder[searchsorted(self.sortedBp, start, side = "left"):searchsorted(self.sortedBp, end, side = "right")])
+  
   def getMarkersByPhysicalRange(self, start, end):
     """returns a list of markers in a sequence range"""
-    return [m for m in self.markers if (m.bp >= start and m.bp <= end)]
+    return self.getMarkers(self.getIndicesByPhysicalRange(start, end))
   def getMarkersByMapRange(self, start, end):
     """returns a list of markers in a map distance (cM) range""" 
-    return [m for m in self.markers if (m.cM >= start and m.cM <= end)]
+    return self.getMarkers(self.getIndicesByMapRange(start, end))
+  
+  def interpolationPoints(self):
+    """Matching (bp, cM) points of the markers with physical positions, in physical order and anchored at the chromosome ends"""
+    bp = self.sortedBp
+    cM = self.cM[self.bpOrder]
+    if len(bp) == 0:
+      raise ValueError, "No markers with physical positions to interpolate between"
+    #positions before the first marker are scaled down to the start of the chromosome, and after the last up to its end
+    if bp[0] > 0 and cM[0] > 0:
+      bp, cM = concatenate(([0.0], bp)), concatenate(([0.0], cM))
+    if self.physLength > bp[-1] and self.mapLength > cM[-1]:
+      bp, cM = concatenate((bp, [self.physLength])), concatenate((cM, [self.mapLength]))
+    #markers out of order on the two maps are smoothed over, so that both conversions are non-decreasing
+    return bp, maximum.accumulate(cM)
+  
+  def cM_to_bp(self, positions):
+    """Physical positions (bp) of map positions (cM), interpolated linearly between markers"""
+    bp, cM = self.interpolationPoints()
+    return interp(positions, cM, bp)
+  
+  def bp_to_cM(self, positions):
+    """Map positions (cM) of physical positions (bp), interpolated linearly between markers"""
+    bp, cM = self.interpolationPoints()
+    return interp(positions, bp, cM)
+
+def chromLabel(label):
+  """Chromosome label from a map file, as an integer when it is one, to match the default chromosome names"""
+  try:
+    return int(label)
+  except ValueError:
+    return label
+
+missingPositions = ("", "NA", "na", "-")
+
+def parsePositions(values):
+  """Float array of positions read as strings, with empty or NA values as nan"""
+  try:
+    return array(values, dtype = float64)
+  except ValueError:
+    return array([nan if v.strip() in missingPositions else float(v) for v in values], dtype = float64)
+
+def isPosition(value):
+  """True if a string is a position or a missing position"""
+  if value.strip() in missingPositions:
+    return True
+  try:
+    float(value)
+  except ValueError:
+    return False
+  return True
+
+def loadMapFile(path, delimiter = None, columns = ("name", "chrom", "cM", "bp"), cache = None):
+  """Reads a tab or comma separated map file into a dictionary of GeneticMaps, one for each chromosome.
+     columns names the fields of each line in order (None for fields to ignore; bp may be left out).  The delimiter
+     is guessed from the first line if not given, and the first line is skipped as a header if none of its position
+     fields is a number or a missing value.
+     If cache is the name of an .npz file (the extension is added if missing) that is newer than the map file and was
+     written with the same columns and delimiter it is read instead; otherwise the parsed map is written to it."""
+  settings = json.dumps(dict(columns = list(columns), delimiter = delimiter), sort_keys = True)
+  if cache != None:
+    if not cache.endswith(".npz"):
+      cache += ".npz"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+      data = load(cache)
+      if "settings" in data.files and data["settings"].item() == settings:
+        return cachedMaps(data)
+  with open(path) as mapFile:
+    lines = mapFile.read().splitlines()
+  lineNumbers = [i + 1 for i, line in enumerate(lines) if line.strip() and not line.startswith("#")]
+  lines = [lines[i - 1] for i in lineNumbers]
+  if len(lines) == 0:
+    raise ValueError, "No markers in map file %s" % path
+  if delimiter == None:
+    if "\t" in lines[0]:
+      delimiter = "\t"
+    elif "," in lines[0]:
+      delimiter = ","
+  fields = dict((column, i) for i, column in enumerate(columns) if column != None)
+  rows = [line.split(delimiter) for line in lines]
+  nFields = len(rows[0])
+  for row, lineNumber in itertools.izip(rows, lineNumbers):
+    if len(row) != nFields:
+      raise ValueError, "Line %d of map file %s has %d fields instead of %d" % (lineNumber, path, len(row), nFields)
+  if nFields <= max(fields.values()):
+    raise ValueError, "Map file %s has %d fields, too few for the columns %s" % (path, nFields, ", ".join(c for c in columns if c != None))
+  if not any([isPosition(rows[0][fields[column]]) for column in ("cM", "bp") if column in fields]):
+    rows = rows[1:]
+    if len(rows) == 0:
+      raise ValueError, "No markers in map file %s" % path
+  table = [list(column) for column in itertools.izip(*rows)]
+  names = array(table[fields["name"]], dtype = object)
+  chromLabels, chroms = unique(array(table[fields["chrom"]]), return_inverse = True)
+  cM = parsePositions(table[fields["cM"]])
+  if "bp" in fields:
+    bp = parsePositions(table[fields["bp"]])
+  else:
+    bp = empty(len(cM))
+    bp.fill(nan)
+  #one sort of all markers, by chromosome and then map position
+  order = lexsort((bp, cM, chroms))
+  names, chroms, cM, bp = names[order], chroms[order], cM[order], bp[order]
+  if cache != None:
+    savez(cache, names = names.astype(str), chroms = chroms, chromLabels = chromLabels, cM = cM, bp = bp, settings = array(settings))
+  return splitMaps(names, chroms, chromLabels, cM, bp)
+
+def loadMapCache(cache):
+  """Reads the dictionary of GeneticMaps from an .npz cache written by loadMapFile"""
+  return cachedMaps(load(cache))
+
+def cachedMaps(data):
+  """Dictionary of GeneticMaps from the arrays of a loaded .npz cache"""
+  return splitMaps(data["names"].astype(object), data["chroms"], data["chromLabels"], data["cM"], data["bp"])
+
+def splitMaps(names, chroms, chromLabels, cM, bp):
+  """Dictionary of GeneticMaps from marker arrays sorted by chromosome code and map position"""
+  bounds = searchsorted(chroms, arange(len(chromLabels) + 1))
+  return dict((chromLabel(label), GeneticMap(chrom = chromLabel(label), names = names[bounds[c]:bounds[c + 1]], cM = cM[bounds[c]:bounds[c + 1]],
+                                             bp = bp[bounds[c]:bounds[c + 1]], presorted = True))
+              for c, label in enumerate(chromLabels.tolist()))
         
 
 class Marker(object):
@@ -75,14 +273,16 @@ class Marker(object):
 
 class AlleleMap(object):
   """Mapping of allele values to marker names for a single individual"""
-  def __init__(self, alleleMap):
+  def __init__(self, alleleMap = None):
     super(AlleleMap, self).__init__()
+    if alleleMap == None:
+      alleleMap = dict()
     self.map = alleleMap
-    if self.map != None and  type(self.map) != type (dict()):
-      raise TypeError, "alleleMap must be a dictionary of dictionaries"
+    if not isinstance(self.map, dict):
+      raise TypeError, "alleleMap must be a dictionary of allele values by marker name"
   
   def addMarker(self, marker, markerValue):
-    if type(marker) == type(Marker()):
+    if isinstance(marker, Marker):
       markerName = marker.name
     else:
       markerName = marker
@@ -92,16 +292,52 @@ class AlleleMap(object):
       self.map[markerName] = markerValue
   
   def getMarker(self, marker):
-    if type(marker) == type(Marker()):
+    if isinstance(marker, Marker):
       markerName = marker.name
     else:
       markerName = marker
     return self.map[markerName]
+  
+  def getAlleles(self, names, missing = None):
+    """List of the alleles of the named markers, with missing for markers not in the map"""
+    return [self.map.get(name, missing) for name in names]
+
+
+class FounderAlleles(object):
+  """Alleles of each founder at the markers of a list of chromosome maps, stored as a (founders x markers) array whose
+     columns are the markers of each map in turn, in map order"""
+  def __init__(self, founders, maps, alleles):
+    self.founders = list(founders)
+    self.maps = list(maps)
+    self.alleles = asarray(alleles)
+    self.offsets = concatenate(([0], cumsum([m.nMarkers for m in self.maps]))).astype(int64)
+    if self.alleles.shape != (len(self.founders), self.offsets[-1]):
+      raise ValueError, "Alleles must be a (founders x markers) array, with a column for every marker of the maps"
+  
+  nMarkers = property(fget = lambda self: self.offsets[-1], doc = "Number of markers on all maps")
+  
+  def getChromosome(self, chrom):
+    """(founders x markers) alleles at the markers of the map of chromosome chrom"""
+    for i, m in enumerate(self.maps):
+      if m.chrom == chrom:
+        return self.alleles[:, self.offsets[i]:self.offsets[i + 1]]
+    raise ValueError, "No map of chromosome %s" % (chrom,)
 
+def founderAllelesFromMaps(alleleMaps, maps, missing = None):
+  """FounderAlleles from a dictionary of AlleleMaps (or of dictionaries of alleles by marker name) by founder, for the markers
+     of a list or dictionary of GeneticMaps.  Markers missing from a founder's map get the allele missing."""
+  if isinstance(maps, dict):
+    maps = [maps[chrom] for chrom in sorted(maps)]
+  founders = sorted(alleleMaps)
+  names = [name for m in maps for name in m.markerNames]
+  alleles = list()
+  for founder in founders:
+    alleleMap = alleleMaps[founder]
+    if not isinstance(alleleMap, AlleleMap):
+      alleleMap = AlleleMap(alleleMap)
+    alleles.append(alleleMap.getAlleles(names, missing))
+  return FounderAlleles(founders, maps, array(alleles).reshape(len(founders), len(names)))
 
-      
-    
-    
 
 if __name__ == '__main__':
   pass
\ No newline at end of file
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Genotypes.py
+
+Observed marker genotypes of simulated populations, from the alleles of their founders
+(GeneticMap.FounderAlleles).  The founder each individual carries at every marker is found from
+the segment tables with one search per chromosome, of the segment starts among the sorted marker
+positions, and the alleles are then filled in with fancy indexing, a block of individuals at a time.
+"""
+from __future__ import division
+
+from numpy import *
+from numpy.lib.format import open_memmap
+from Chromosomes import *
+import Population
+import Statistics
+
+
+def founderRows(founders):
+    """Array from parent code to the founder's row in founders, with len(founders) for parents that are not founders"""
+    codes = [internParent(f) for f in founders]
+    rows = empty(len(parentLabels), dtype = int64)
+    rows.fill(len(founders))
+    rows[codes] = arange(len(founders))
+    return rows
+
+def fillAlleles(out, table, locs, rows, alleles, chunkSize = 2**22):
+    """Fills out (individuals x markers) with the allele of the founder that each individual of a SegmentTable carries at each
+       of the sorted marker locations locs.  rows maps parent codes to rows of alleles, a (founders + 1 x markers) array whose
+       last row holds the allele for parents that are not founders."""
+    nMarkers = len(locs)
+    if nMarkers == 0:
+        return
+    runs = markerRuns(table, locs)
+    #flat index into alleles of the first marker of each segment's founder, to which each marker's column is added
+    founderStart = rows[table.codes] * nMarkers
+    columns = arange(nMarkers)
+    flatAlleles = alleles.ravel()
+    blockRows = max(1, chunkSize // nMarkers)
+    for first in xrange(0, len(table), blockRows):
+        last = min(first + blockRows, len(table))
+        segments = slice(table.offsets[first], table.offsets[last])
+        index = repeat(founderStart[segments], runs[segments]).reshape(last - first, nMarkers)
+        index += columns
+        out[first:last] = flatAlleles.take(index)
+
+def markerAlleles(population, founderAlleles, missing = -1, out = None, chunkSize = 2**22):
+    """Alleles observed at every marker of founderAlleles (a GeneticMap.FounderAlleles) in each individual of a population:
+       the allele of the founder that the individual carries at the marker, or missing if it is none of the founders.
+       The maps are matched to the population's chromosomes by name and their cM positions taken on the simulated chromosomes.
+       The population is anything Statistics.populationTables reads.  Returns an (individuals x markers) array, or for a
+       DiploidPopulation an (individuals x 2 x markers) array of the alleles on each chromosome set.  out is an array of either
+       shape to fill, or the name of a .npy file to write as a memory-mapped array (for populations with a length)."""
+    nMarkers = founderAlleles.nMarkers
+    alleles = concatenate((founderAlleles.alleles, array([missing], dtype = founderAlleles.alleles.dtype).repeat(nMarkers)[newaxis, :]))
+    diploid = isinstance(population, Population.DiploidPopulation)
+    if out is not None:
+        if isinstance(out, basestring):
+            shape = (len(population), 2, nMarkers) if diploid else (len(population), nMarkers)
+            out = open_memmap(out, mode = "w+", dtype = alleles.dtype, shape = shape)
+        result = out
+        out = out.reshape(-1, nMarkers)
+    rows = founderRows(founderAlleles.founders)
+    blocks = list()
+    row = 0
+    for tables in Statistics.populationTables(population):
+        byName = dict((table.name, table) for table in tables)
+        n = len(tables[0])
+        if out is None:
+            block = empty((n, nMarkers), dtype = alleles.dtype)
+            blocks.append(block)
+        else:
+            block = out[row:row + n]
+        for i, geneticMap in enumerate(founderAlleles.maps):
+            if geneticMap.chrom not in byName:
+                raise ValueError, "No chromosome named %s to place markers on" % (geneticMap.chrom,)
+            table = byName[geneticMap.chrom]
+            if geneticMap.nMarkers > 0 and (geneticMap.cM[0] < 0 or geneticMap.cM[-1] > table.cM):
+                raise ValueError, "Markers must be within the range of chromosome %s" % (geneticMap.chrom,)
+            columns = slice(founderAlleles.offsets[i], founderAlleles.offsets[i + 1])
+            fillAlleles(block[:, columns], table, geneticMap.cM / table.cM, rows, ascontiguousarray(alleles[:, columns]), chunkSize)
+        row += n
+    if out is None:
+        if len(blocks) == 1:
+            result = blocks[0]
+        else:
+            result = concatenate(blocks) if len(blocks) > 0 else empty((0, nMarkers), dtype = alleles.dtype)
+    if diploid:
+        result = result.reshape(len(population), 2, nMarkers)
+    return result
+
+
+if __name__ == '__main__':
+    import GeneticMap
+    founders = Population.DiploidPopulation(names = ["A", "B"], newChr = 2, cM = 100)
+    F2 = founders.mate([0], [1]).mate(zeros(10, dtype = int), zeros(10, dtype = int))
+    maps = [GeneticMap.GeneticMap(chrom = chrom, names = ["m%d_%d" % (chrom, i) for i in range(11)], cM = arange(0, 101, 10)) for chrom in (1, 2)]
+    alleles = GeneticMap.FounderAlleles(["A", "B"], maps, array([zeros(22), ones(22)], dtype = int8))
+    genotypes = markerAlleles(F2, alleles).sum(axis = 1)
+    for i, genotype in enumerate(genotypes):
+        print "F2 %d: %s" % (i, "".join(str(g) for g in genotype))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+IBD.py
+
+Identity by descent between individuals of a population: two haploid chromosomes are IBD wherever
+they carry the same founder's segment.  The kinship matrix of a population is computed in blocks
+of pairs, optionally on a pool of processes, from running totals of each individual's founder
+lengths along the sorted segment boundaries (ChromosomeSweep); single pairs can also be swept over
+their merged boundaries (pairIntervals).
+"""
+from __future__ import division
+import itertools
+import multiprocessing
+
+from numpy import *
+from numpy.lib.format import open_memmap
+from Chromosomes import *
+import Population
+import Ancestry
+
+
+def asPopulation(population):
+    """HaploidPopulation for a HaploidPopulation, AncestryPopulation or list of haploids"""
+    if isinstance(population, Population.HaploidPopulation):
+        return population
+    if isinstance(population, Ancestry.AncestryPopulation):
+        return population.toPopulation()
+    return Population.HaploidPopulation(individuals = population)
+
+def tableKeys(table):
+    """Sorted complex search keys (row + 1j * start) of the segments of a SegmentTable"""
+    return repeat(arange(len(table)), diff(table.offsets)) + 1j * table.starts
+
+def pairIntervals(table, rowsA, rowsB, keys = None):
+    """Sweep over the merged segment boundaries of each pair of rows rowsA[i], rowsB[i] of a SegmentTable.
+       Returns, for every interval between consecutive boundaries of a pair, the pair index, the interval's start and end
+       (as fractions of the chromosome) and the parent codes of both rows, sorted by pair and position."""
+    if keys is None:
+        keys = tableKeys(table)
+    counts = diff(table.offsets)
+    nA = counts[rowsA]
+    nB = counts[rowsB]
+    pairs = arange(len(rowsA))
+    pair = concatenate((repeat(pairs, nA), repeat(pairs, nB)))
+    segment = concatenate((repeat(table.offsets[rowsA] - (cumsum(nA) - nA), nA) + arange(nA.sum()),
+                           repeat(table.offsets[rowsB] - (cumsum(nB) - nB), nB) + arange(nB.sum())))
+    starts = table.starts[segment]
+    order = lexsort((starts, pair))
+    pair, starts = pair[order], starts[order]
+    ends = append(starts[1:], 1.0)
+    ends[append(pair[1:] != pair[:-1], True)] = 1.0
+    #parent of each row at each boundary: its last segment starting at or before it
+    codesA = table.codes[searchsorted(keys, rowsA[pair] + 1j * starts, side = "right") - 1]
+    codesB = table.codes[searchsorted(keys, rowsB[pair] + 1j * starts, side = "right") - 1]
+    return pair, starts, ends, codesA, codesB
+
+class ChromosomeSweep(object):
+    """Cumulative founder lengths along each individual of a SegmentTable, for comparing many pairs at once.
+       For segment k, prefix[k, f] is the length of the segments of the same individual before k that came from founder f
+       (founders numbered by founderIndex), so the length that an individual shares with founder f up to any position is
+       one lookup away once its last segment starting at or before that position is known."""
+    def __init__(self, table):
+        self.table = table
+        counts = diff(table.offsets)
+        row = repeat(arange(len(table)), counts)
+        self.ends = append(table.starts[1:], 1.0)
+        self.ends[table.offsets[1:][counts > 0] - 1] = 1.0
+        founders, self.founderIndex = unique(table.codes, return_inverse = True)
+        lengths = zeros((len(table.starts), len(founders)))
+        lengths[arange(len(table.starts)), self.founderIndex] = self.ends - table.starts
+        self.prefix = cumsum(lengths, axis = 0) - lengths
+        self.prefix -= self.prefix[table.offsets[:-1]][row]
+    
+    def segmentsOf(self, rows):
+        """Indices of the segments of rows, concatenated in order, and the number of segments of each row"""
+        counts = diff(self.table.offsets)[rows]
+        return repeat(self.table.offsets[rows] - (cumsum(counts) - counts), counts) + arange(counts.sum()), counts
+    
+    def sharedLengths(self, rowsI, rowsJ):
+        """(len(rowsI) x len(rowsJ)) matrix of the length, as a fraction of the chromosome, that each pair inherited from the same founder"""
+        table = self.table
+        segmentsI, countsI = self.segmentsOf(rowsI)
+        segmentsJ, countsJ = self.segmentsOf(rowsJ)
+        #sorted positions at which the individuals of rowsJ are looked up: both ends of every segment of rowsI
+        positions = unique(concatenate((table.starts[segmentsI], self.ends[segmentsI])))
+        #last segment of each individual of rowsJ starting at or before each position, from a running count of its segment starts
+        starts = zeros((len(rowsJ), len(positions) + 1), dtype = int32)
+        add.at(starts, (repeat(arange(len(rowsJ)), countsJ), searchsorted(positions, table.starts[segmentsJ], side = "left")), 1)
+        last = cumsum(starts[:, :-1], axis = 1) - 1 + table.offsets[rowsJ][:, newaxis]
+        #length each of rowsJ shares with the founder of each segment of rowsI, up to the segment's start and end
+        founder = self.founderIndex[segmentsI][newaxis, :]
+        def sharedTo(x, k):
+            return self.prefix[k, founder] + (self.founderIndex[k] == founder) * (x - table.starts[k])
+        startColumns = searchsorted(positions, table.starts[segmentsI])
+        endColumns = searchsorted(positions, self.ends[segmentsI])
+        shared = sharedTo(self.ends[segmentsI][newaxis, :], last[:, endColumns]) - sharedTo(table.starts[segmentsI][newaxis, :], last[:, startColumns])
+        return add.reduceat(shared, concatenate(([0], cumsum(countsI)[:-1])), axis = 1).T
+
+def pairIBD(table, rowsA, rowsB, keys = None):
+    """Fraction of the chromosome that each pair of rows rowsA[i], rowsB[i] of a SegmentTable inherited from the same founder"""
+    pair, starts, ends, codesA, codesB = pairIntervals(table, rowsA, rowsB, keys)
+    return bincount(pair, weights = (ends - starts) * (codesA == codesB), minlength = len(rowsA))
+
+def ibdBlock(tables, rowsI, rowsJ, sweeps = None):
+    """(len(rowsI) x len(rowsJ)) matrix of the fraction of the genome (weighting chromosomes by cM) that each pair of
+       individuals shares IBD"""
+    if sweeps is None:
+        sweeps = [ChromosomeSweep(table) for table in tables]
+    genomeLength = sum(table.cM for table in tables)
+    shared = zeros((len(rowsI), len(rowsJ)))
+    for table, sweep in itertools.izip(tables, sweeps):
+        shared += sweep.sharedLengths(rowsI, rowsJ) * (table.cM / genomeLength)
+    return shared
+
+#segment tables and their sweeps in each worker process of kinshipMatrix
+workerTables = None
+
+def setWorkerTables(tables):
+    global workerTables
+    workerTables = (tables, [ChromosomeSweep(table) for table in tables])
+
+def workerBlock(block):
+    rowsI, rowsJ = block
+    tables, sweeps = workerTables
+    return rowsI, rowsJ, ibdBlock(tables, rowsI, rowsJ, sweeps)
+
+def kinshipMatrix(population, blockSize = 128, processes = 1, out = None, dtype = float64):
+    """Matrix of the fraction of the genome that each pair of haploid individuals of a population shares IBD, which for haploids
+       is their kinship coefficient.  Pairs are compared in blocks of blockSize x blockSize individuals, on a pool of processes
+       if processes > 1.  out is an array to fill, or the name of a .npy file to write as a memory-mapped array."""
+    population = asPopulation(population)
+    n = len(population)
+    if out is None:
+        out = empty((n, n), dtype = dtype)
+    elif isinstance(out, basestring):
+        out = open_memmap(out, mode = "w+", dtype = dtype, shape = (n, n))
+    elif out.shape != (n, n):
+        raise ValueError, "Output array must be %d x %d" % (n, n)
+    bounds = range(0, n, blockSize)
+    blocks = [(arange(i, min(i + blockSize, n)), arange(j, min(j + blockSize, n))) for i in bounds for j in bounds if j >= i]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer = setWorkerTables, initargs = (population.tables,))
+        results = pool.imap_unordered(workerBlock, blocks)
+    else:
+        setWorkerTables(population.tables)
+        results = itertools.imap(workerBlock, blocks)
+    for rowsI, rowsJ, block in results:
+        if rowsI[0] == rowsJ[0]:
+            #diagonal blocks hold both orders of each pair; keep one so that the matrix is exactly symmetric
+            block = triu(block) + triu(block, 1).T
+        out[rowsI[0]:rowsI[-1] + 1, rowsJ[0]:rowsJ[-1] + 1] = block
+        out[rowsJ[0]:rowsJ[-1] + 1, rowsI[0]:rowsI[-1] + 1] = block.T
+    if processes > 1:
+        pool.close()
+        pool.join()
+    fill_diagonal(out, 1)
+    return out
+
+def sharedSegments(population, a, b):
+    """Segments that individuals a and b inherited from the same founder, as a list of (chromosome name, start cM, end cM, founder)"""
+    population = asPopulation(population)
+    segments = list()
+    for table in population.tables:
+        pair, starts, ends, codesA, codesB = pairIntervals(table, array([a]), array([b]))
+        shared = codesA == codesB
+        #join consecutive shared intervals of the same founder
+        newSegment = shared.copy()
+        newSegment[1:] &= ~(shared[:-1] & (codesA[1:] == codesA[:-1]))
+        first = nonzero(newSegment)[0]
+        last = append(first[1:], len(shared))
+        for start, end in itertools.izip(first, last):
+            end = start + argmin(append(shared[start:end], False))
+            segments.append((table.name, starts[start] * table.cM, ends[end - 1] * table.cM, parentLabels[codesA[start]]))
+    return segments
+
+
+if __name__ == '__main__':
+    population = Population.HaploidPopulation(names = ["a","b","c","d","e","f","g","h"], newChr = 2)
+    for _ in range(5):
+        population = population.mate(random.randint(0, len(population), size = 500),
+                                     random.randint(0, len(population), size = 500))
+    kinship = kinshipMatrix(population)
+    print "Mean kinship: %f" % kinship[triu_indices(len(population), 1)].mean()
+    for segment in sharedSegments(population, 0, 1):
+        print "Chr %s: %.2f-%.2f cM from %s" % segment
@@ -10,7 +10,9 @@ import operator
 import itertools
 
 from numpy import *
+from numpy.lib.format import open_memmap
 from Chromosomes import *
+import GeneticMap
 
 def newChromosomes(parent, n = None, cM = 200, chrNames=None, interference = "absent"):
     """Generates a list of n chromosomes, each with length cM (possibly a list, in which case n is optional)"""
@@ -39,17 +41,82 @@ def alleleCompare(a,b, P1):
     genotype = 1
   return genotype
 
+def genotypeLoci(chromosomes, interval = 1, cM = True, markers = None):
+    """Loci to genotype on each chromosome, as a list of (chromosome index, positions) with positions in map units (cM) 
+       or fractions of the chromosome.  Loci are evenly spaced unless markers is given as a GeneticMap, a list of 
+       GeneticMaps or a dictionary of cM positions, each matched to a chromosome by name."""
+    if markers == None:
+        if cM:
+            return [(chrom, array([i * interval for i in xrange(int(c.cM//interval))] + [c.cM], dtype = float64))
+                    for chrom, c in enumerate(chromosomes)]
+        positions = array([i * interval for i in xrange(int(1//interval))] + [1.0], dtype = float64)
+        return [(chrom, positions) for chrom in range(len(chromosomes))]
+    if isinstance(markers, GeneticMap.GeneticMap):
+        markers = [markers]
+    if not isinstance(markers, dict):
+        markers = dict((m.chrom, m.cM) for m in markers if m.nMarkers > 0)
+    names = [c.name for c in chromosomes]
+    for name in markers:
+        if name not in names:
+            raise ValueError, "No chromosome named %s to place markers on" % (name,)
+    return [(chrom, array(markers[c.name], dtype = float64)) for chrom, c in enumerate(chromosomes) if c.name in markers]
+
+def getPopulationGenos(population, interval = 1, cM = True, markers = None, reference = None, out = None, chunkSize = 2**20):
+    """Genotypes of every individual of a list of diploids as an (individuals x loci) int8 matrix, coded as in Diploid.getAllGenos.
+       Loci are chosen as in genotypeLoci; the reference defaults to the parent at the start of the first individual's first chromosome.
+       out is an int8 array to fill, or the name of a .npy file to write as a memory-mapped array.  The matrix is filled in blocks
+       of about chunkSize genotypes, from the number of loci in each segment (see markerRuns), so memory use does not grow with it.
+       Returns the genotype matrix and a list of (chromosome index, position) for each locus."""
+    loci = genotypeLoci(population[0].chromosome_set[0], interval = interval, cM = cM, markers = markers)
+    nLoci = sum(len(positions) for _, positions in loci)
+    if reference == None:
+        reference = population[0].chromosome_set[0][0].getParentAtLocation(0)
+    reference = internParent(reference)
+    if out is None:
+        out = empty((len(population), nLoci), dtype = int8)
+    elif isinstance(out, basestring):
+        out = open_memmap(out, mode = "w+", dtype = int8, shape = (len(population), nLoci))
+    elif out.shape != (len(population), nLoci) or out.dtype != int8:
+        raise ValueError, "out must be an int8 array of shape (%d, %d)" % (len(population), nLoci)
+    
+    column = 0
+    for chrom, positions in loci:
+        #marker positions are always in cM
+        if cM or markers != None:
+            locs = positions / population[0].chromosome_set[0][chrom].cM
+        else:
+            locs = positions
+        if len(locs) > 0 and (locs.min() < 0 or locs.max() > 1):
+            raise ValueError, "Locations must be in range [0,1]"
+        order = argsort(locs, kind = "mergesort")
+        locs = locs[order]
+        blockRows = max(1, chunkSize // max(len(locs), 1))
+        for first in xrange(0, len(population), blockRows):
+            block = population[first:first + blockRows]
+            #parent codes of both chromosome sets at each locus, repeated over the loci within each segment
+            alleles = list()
+            for chrSet in (0, 1):
+                table = SegmentTable(chromosomes = [ind.chromosome_set[chrSet][chrom] for ind in block])
+                alleles.append(repeat(table.codes, markerRuns(table, locs)).reshape(len(block), len(locs)))
+            allelesA, allelesB = alleles
+            genotypes = (allelesA == reference).astype(int8)
+            genotypes *= 2
+            genotypes[allelesA != allelesB] = 1
+            out[first:first + len(block), column + order] = genotypes
+        column += len(locs)
+    return out, [(chrom, pos) for chrom, positions in loci for pos in positions.tolist()]
+
 class Diploid(object):
     """ Diploid individual, monoecious"""
-    def __init__(self,  name = None, chromosome_set = None, newChr = None, cM = 200, chrNames = None):
+    def __init__(self,  name = None, chromosome_set = None, newChr = None, cM = 200, chrNames = None, interference = "absent"):
         self.name = name
         if (chromosome_set == None and newChr == None) or (chromosome_set != None and newChr != None):
               raise ValueError, "Must specify only one of either the number of new Chromosomes to add or sets of the chromosomes themselves."
         elif chromosome_set != None:
             self.chromosome_set = chromosome_set
         else:
-            self.chromosome_set = (newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames),
-                                   newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames) )
+            self.chromosome_set = (newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames, interference = interference),
+                                   newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames, interference = interference) )
         for chr_list in self.chromosome_set:
             chr_list.sort(key= operator.attrgetter("name"))
        
@@ -57,15 +124,21 @@ class Diploid(object):
         return len(self.chromosome_set[0])
     nChr = property(fget= getNChr, doc = "Number of chromosomes")
        
-    def make_gamete(self):
-        gamete = []
-        for maternal, paternal in itertools.izip (self.chromosome_set[0], self.chromosome_set[1]):
-            gamete.append(maternal.recombine(paternal)[0])
-        return gamete
+    def drawGamete(self, rng = random):
+        """Random draws for each chromosome of a gamete; see Chromosome.drawGamete"""
+        return [maternal.drawGamete(paternal, rng = rng) for maternal, paternal in itertools.izip (self.chromosome_set[0], self.chromosome_set[1])]
+    
+    def make_gamete(self, rng = random):
+        """Single recombinant product of each chromosome pair.  The splicing runs on the meiosis thread pool, if one is set."""
+        return mapMeioses(spliceGamete, *zip(*self.drawGamete(rng)))
 
-    def mate(self, partner, nOffspring = 1):
-        offspring = [Diploid(chromosome_set = (self.make_gamete(), partner.make_gamete()))   
-                     for _ in xrange(nOffspring) ]
+    def mate(self, partner, nOffspring = 1, rng = random):
+        #draw every gamete first, so that the splicing of all offspring can be spread over the meiosis thread pool
+        draws = [self.drawGamete(rng) + partner.drawGamete(rng) for _ in xrange(nOffspring)]
+        gametes = mapMeioses(spliceGamete, *zip(*[d for offspringDraws in draws for d in offspringDraws]))
+        nChr = self.nChr
+        offspring = [Diploid(chromosome_set = (gametes[i * 2 * nChr:(i * 2 + 1) * nChr], gametes[(i * 2 + 1) * nChr:(i + 1) * 2 * nChr]))
+                     for i in xrange(nOffspring) ]
         return offspring
     
     def getAllGenos(self, interval= 1, cM = True, reference = None):
@@ -73,59 +146,39 @@ class Diploid(object):
          The return is the locations, with the genotype coded as 0,1,2 as the number of alleles equal to the reference (arbitrary if not specified)."""
       if not reference:
         reference = self.chromosome_set[0][0].getParentAtLocation(0)
-      genotype = []
-      if cM:
-        for chrom in range(self.nChr):
-          chrLength = self.chromosome_set[0][chrom].cM
-          nPos = int(chrLength//interval)
-          positions = [i * interval for i in xrange(nPos)] + [chrLength]
-          allelesA = self.chromosome_set[0][chrom].getParentAtMapLocs(positions)
-          allelesB = self.chromosome_set[1][chrom].getParentAtMapLocs(positions)
-          loci = [ (chrom, pos, alleleCompare(a,b,reference) )
-                  for pos, a, b 
-                  in itertools.izip(positions, allelesA, allelesB)]
-          genotype += loci
-      else:
-        nPos = int(1//interval)
-        positions = [i * interval for i in xrange(nPos)] + [1.0]
-        for chrom in range(self.nChr):
-          allelesA = self.chromosome_set[0][chrom].getParentAtLocations(positions)
-          allelesB = self.chromosome_set[1][chrom].getParentAtLocations(positions)
-          loci = [ (chrom, pos, alleleCompare(a,b,reference) )
-                  for pos, a, b 
-                  in itertools.izip(positions, allelesA, allelesB)]
-          genotype += loci
-      return genotype      
+      genotypes, loci = getPopulationGenos([self], interval = interval, cM = cM, reference = reference)
+      return [(chrom, pos, genotype) for (chrom, pos), genotype in itertools.izip(loci, genotypes[0].tolist())]
                   
                 
         
 class Haploid(object):
     """Haploid individual, monoecious"""
-    def __init__(self, name = None, chromosomes = None, newChr = None, cM = 200, chrNames = None):
+    def __init__(self, name = None, chromosomes = None, newChr = None, cM = 200, chrNames = None, interference = "absent"):
         self.name = name
         if (chromosomes == None and newChr == None) or (chromosomes != None and newChr != None):
             raise ValueError, "Must specify only one of either the number of new Chromosomes to add or a list of the chromosomes themselves."
         elif chromosomes != None:
             self.chromosomes = chromosomes
         elif newChr != None:
-            self.chromosomes = newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames)
+            self.chromosomes = newChromosomes(parent = self.name, n = newChr, cM = cM, chrNames = chrNames, interference = interference)
         self.chromosomes.sort(key= operator.attrgetter("name"))
     
     def getNChr(self):
         return len(self.chromosomes)
     nChr = property(fget= getNChr, doc = "Number of chromosomes")
     
-    def mate(self, mate, nOffspring = 1):
+    def mate(self, mate, nOffspring = 1, rng = random):
         if type(mate) != type (self):
             raise TypeError, "Haploid individuals can only mate with other haploids"
         if self.nChr != mate.nChr:
             raise ValueError, "Individuals to mate must have the same number of chromosomes"
         
+        #draw every meiosis first, so that the splicing of all offspring can be spread over the meiosis thread pool
+        draws = [selfChr.drawGamete(mateChr, rng = rng) for __ in range(nOffspring) for selfChr, mateChr in itertools.izip(self.chromosomes, mate.chromosomes)]
+        gametes = mapMeioses(spliceGamete, *zip(*draws))
+        offspring = [Haploid( chromosomes = gametes[i * self.nChr:(i + 1) * self.nChr] ) for i in range(nOffspring)]
         if nOffspring == 1:
-            offspring = Haploid( chromosomes = [ selfChr.recombine(mateChr)[0] for selfChr, mateChr in itertools.izip(self.chromosomes, mate.chromosomes) ] )
-        else:
-            offspring = [Haploid( chromosomes = [ selfChr.recombine(mateChr)[0] for selfChr, mateChr in itertools.izip(self.chromosomes, mate.chromosomes) ] )
-                        for __ in range(nOffspring)]
+            return offspring[0]
         return offspring
     
         
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Instrumentation.py
+
+Optional counters and timers for the hot paths of a simulation.  Instrumentation is off unless
+enable() is called; call sites check the module's enabled flag first, so when it is off each
+one costs a single attribute lookup.
+"""
+from __future__ import division
+import time
+import contextlib
+import threading
+
+enabled = False
+counters = dict()
+timings = dict()
+#counters are updated from the meiosis worker threads of Chromosomes.mapMeioses
+lock = threading.Lock()
+
+def enable(on = True):
+    """Turns instrumentation on (or off), clearing anything recorded so far"""
+    global enabled
+    enabled = on
+    reset()
+
+def reset():
+    counters.clear()
+    timings.clear()
+
+def count(name, n = 1):
+    """Adds n to the counter name"""
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+@contextlib.contextmanager
+def recordTime(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        with lock:
+            timings.setdefault(name, []).append(time.time() - start)
+
+@contextlib.contextmanager
+def noTimer():
+    yield
+
+def timer(name):
+    """Context manager that records the time spent in its block under name, if instrumentation is on"""
+    if enabled:
+        return recordTime(name)
+    return noTimer()
+
+def summary():
+    """Counters, the rate of meioses between identical chromosomes (among those whose parents were compared, which
+       excludes meioses recorded as ancestry edges), and for each timer its number of calls and total, mean and longest
+       time in seconds"""
+    result = dict(counters)
+    checked = counters.get("meioses", 0) - counters.get("uncheckedMeioses", 0)
+    if checked > 0:
+        result["identicalRate"] = counters.get("identicalMeioses", 0) / checked
+    result["timers"] = dict((name, dict(calls = len(times), total = sum(times), mean = sum(times) / len(times), max = max(times)))
+                            for name, times in timings.items())
+    return result
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Population.py
+
+Populations of individuals stored as one segment table per chromosome, so that a whole
+generation can be produced from a few array operations.
+"""
+from __future__ import division
+import os
+import json
+import itertools
+import weakref
+
+from numpy import *
+from numpy.lib.format import open_memmap
+from Chromosomes import *
+from Individual import newChromosomes
+import Individual
+import CrossoverModels
+
+
+class HaploidPopulation(object):
+    """Population of haploid individuals, stored as a SegmentTable for each chromosome.
+       parts holds weak references to the populations that joinPopulations made it from, if any."""
+    def __init__(self, names = None, individuals = None, tables = None, newChr = None, cM = 200, chrNames = None, interference = "absent"):
+        if len([x for x in (individuals, tables, newChr) if x is not None]) != 1:
+            raise ValueError, "Must specify only one of a list of individuals, a list of segment tables or the number of new chromosomes for each founder."
+        if newChr != None:
+            if names is None:
+                raise ValueError, "Must specify founder names"
+            individuals = [Individual.Haploid(name = name, chromosomes = newChromosomes(parent = name, n = newChr, cM = cM, chrNames = chrNames, interference = interference))
+                           for name in names]
+        if individuals != None:
+            if names is None:
+                names = [ind.name for ind in individuals]
+            tables = [SegmentTable(chromosomes = list(chrs))
+                      for chrs in itertools.izip(*[ind.chromosomes for ind in individuals])]
+        self.tables = list(tables)
+        if names is None:
+            names = [None] * len(self)
+        elif len(names) != len(self):
+            raise ValueError, "Must have one name for each individual"
+        self.names = list(names)
+        for table in self.tables:
+            if len(table) != len(self.tables[0]):
+                raise ValueError, "All segment tables must have the same number of individuals"
+        self.parts = list()
+
+    def __len__(self):
+        if len(self.tables) == 0:
+            return 0
+        return len(self.tables[0])
+
+    def getNChr(self):
+        return len(self.tables)
+    nChr = property(fget = getNChr, doc = "Number of chromosomes")
+
+    def __getitem__(self, i):
+        return Individual.Haploid(name = self.names[i], chromosomes = [table.getChromosome(i) for table in self.tables])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def toIndividuals(self):
+        """List of Haploid individuals"""
+        return list(self)
+
+    def mate(self, rowsA, rowsB, rng = random):
+        """Produces one offspring from each pair of individuals rowsA[i] x rowsB[i].
+           Crossovers for the whole generation are drawn by drawMeioses; the chromosomes are spliced on the meiosis thread pool, if one is set."""
+        rowsA = asarray(rowsA, dtype = int64)
+        rowsB = asarray(rowsB, dtype = int64)
+        if len(rowsA) != len(rowsB):
+            raise ValueError, "Must have the same number of individuals in each set of parents"
+        counts, crossOvers, fromA = drawMeioses(self.tables, len(rowsA), rng)
+        tables = mapMeioses(lambda table, chrCounts, chrCrossOvers, chrFromA: table.recombine(rowsA, rowsB, chrCounts, chrCrossOvers, chrFromA),
+                            self.tables, counts, crossOvers, fromA)
+        offspring = HaploidPopulation(tables = tables)
+        if mateObservers:
+            notifyMateObservers(self, offspring, rowsA, rowsB, counts, crossOvers, fromA)
+        return offspring
+
+
+class DiploidPopulation(object):
+    """Population of diploid individuals, stored as a HaploidPopulation of their chromosome sets:
+       haplotype rows 2i and 2i + 1 are the two chromosome sets of individual i"""
+    def __init__(self, names = None, individuals = None, haplotypes = None, newChr = None, cM = 200, chrNames = None, interference = "absent"):
+        if len([x for x in (individuals, haplotypes, newChr) if x is not None]) != 1:
+            raise ValueError, "Must specify only one of a list of individuals, a population of haplotypes or the number of new chromosomes for each founder."
+        if newChr != None:
+            if names is None:
+                raise ValueError, "Must specify founder names"
+            individuals = [Individual.Diploid(name = name, newChr = newChr, cM = cM, chrNames = chrNames, interference = interference)
+                           for name in names]
+        if individuals != None:
+            if names is None:
+                names = [ind.name for ind in individuals]
+            haplotypes = HaploidPopulation(individuals = [Individual.Haploid(chromosomes = list(chrs))
+                                                          for ind in individuals for chrs in ind.chromosome_set])
+        if len(haplotypes) % 2 != 0:
+            raise ValueError, "Must have two haplotypes for each individual"
+        self.haplotypes = haplotypes
+        if names is None:
+            names = [None] * len(self)
+        elif len(names) != len(self):
+            raise ValueError, "Must have one name for each individual"
+        self.names = list(names)
+
+    def __len__(self):
+        return len(self.haplotypes) // 2
+
+    def getNChr(self):
+        return self.haplotypes.nChr
+    nChr = property(fget = getNChr, doc = "Number of chromosomes")
+
+    def getTables(self):
+        return self.haplotypes.tables
+    tables = property(fget = getTables, doc = "SegmentTable of the haplotypes of each chromosome")
+
+    def __getitem__(self, i):
+        return Individual.Diploid(name = self.names[i], chromosome_set = (self.haplotypes[2 * i].chromosomes, self.haplotypes[2 * i + 1].chromosomes))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def toIndividuals(self):
+        """List of Diploid individuals"""
+        return list(self)
+
+    def mate(self, rowsA, rowsB, rng = random):
+        """Produces one offspring from each pair of individuals rowsA[i] x rowsB[i].
+           The gametes of the whole generation are made by one mating of the haplotypes, each gamete a meiosis between the two
+           chromosome sets of a parent; an offspring's first chromosome set comes from parent A and its second from parent B."""
+        rowsA = asarray(rowsA, dtype = int64)
+        rowsB = asarray(rowsB, dtype = int64)
+        if len(rowsA) != len(rowsB):
+            raise ValueError, "Must have the same number of individuals in each set of parents"
+        parents = column_stack((rowsA, rowsB)).ravel()
+        return DiploidPopulation(haplotypes = self.haplotypes.mate(2 * parents, 2 * parents + 1, rng))
+
+
+def joinPopulations(populations):
+    """Population with the individuals of each of a list of HaploidPopulations, or of DiploidPopulations, in order"""
+    names = [name for population in populations for name in population.names]
+    if isinstance(populations[0], DiploidPopulation):
+        return DiploidPopulation(haplotypes = joinPopulations([population.haplotypes for population in populations]), names = names)
+    joined = HaploidPopulation(tables = [joinTables(tables) for tables in itertools.izip(*[population.tables for population in populations])],
+                               names = names)
+    joined.parts = [weakref.ref(population) for population in populations]
+    return joined
+
+
+#functions called after every batched generation; see addMateObserver
+mateObservers = list()
+
+def addMateObserver(observer):
+    """Calls observer(parents, offspring, rowsA, rowsB, counts, crossOvers, fromA) after every generation made by the mate()
+       of a HaploidPopulation or AncestryPopulation (and so of a DiploidPopulation, through its haplotypes), with the parent
+       rows and the crossover draws of drawMeioses.  Observers are called before the offspring are used for anything else."""
+    mateObservers.append(observer)
+
+def removeMateObserver(observer):
+    mateObservers.remove(observer)
+
+def notifyMateObservers(parents, offspring, rowsA, rowsB, counts, crossOvers, fromA):
+    for observer in list(mateObservers):
+        observer(parents, offspring, rowsA, rowsB, counts, crossOvers, fromA)
+
+
+def drawMeioses(chromosomes, nOffspring, rng = random):
+    """Draws the crossovers for nOffspring meioses of each chromosome, all meioses of a chromosome at once from its crossover model.
+       chromosomes is a list of objects with cM and interference (CrossoverModel) attributes, such as SegmentTables,
+       and rng is the RandomState (or the numpy.random module) to draw from.
+       Returns, for each chromosome, the crossover counts of each meiosis, the crossover positions (consecutive and sorted
+       within each meiosis) and whether each product starts with the first parent.
+       When no chromosome has interference, the counts and positions of all chromosomes are drawn together, as before
+       crossover models were added, so that seeds give the same results as they did then."""
+    if all([isinstance(chrom.interference, CrossoverModels.NoInterference) for chrom in chromosomes]):
+        counts = rng.poisson([chrom.cM/100.0 for chrom in chromosomes], size = (nOffspring, len(chromosomes))).T
+        crossOvers = rng.uniform(size = counts.sum())
+        crossOvers = crossOvers[lexsort((crossOvers, repeat(arange(counts.size), counts.ravel())))]
+        crossOvers = split(crossOvers, cumsum(counts.sum(axis = 1))[:-1])
+        fromA = rng.binomial(1, 0.5, size = (len(chromosomes), nOffspring)).astype(bool)
+        return list(counts), crossOvers, fromA
+    counts = list()
+    crossOvers = list()
+    for chrom in chromosomes:
+        chrCounts, chrCrossOvers = chrom.interference.sample(chrom.cM, nOffspring, rng)
+        counts.append(chrCounts)
+        crossOvers.append(chrCrossOvers)
+    fromA = rng.binomial(1, 0.5, size = (len(chromosomes), nOffspring)).astype(bool)
+    return counts, crossOvers, fromA
+
+
+def savePopulation(population, path):
+    """Writes a HaploidPopulation or DiploidPopulation (or list of haploids or diploids) to the directory path as a snapshot that
+       loadPopulation can memory-map.  The segments of all chromosomes go into flat starts.npy and codes.npy arrays; offsets.npy
+       holds each chromosome's per-individual offsets and chrOffsets.npy the start of each chromosome in the flat arrays.
+       A diploid population is stored as the table of its chromosome sets."""
+    if not isinstance(population, (HaploidPopulation, DiploidPopulation)):
+        population = list(population)
+        if len(population) > 0 and isinstance(population[0], Individual.Diploid):
+            population = DiploidPopulation(individuals = population)
+        else:
+            population = HaploidPopulation(individuals = population)
+    diploid = isinstance(population, DiploidPopulation)
+    names = population.names
+    if diploid:
+        population = population.haplotypes
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    chrOffsets = concatenate(([0], cumsum([len(table.starts) for table in population.tables]))).astype(int64)
+    starts = open_memmap(os.path.join(path, "starts.npy"), mode = "w+", dtype = float64, shape = (chrOffsets[-1],))
+    codes = open_memmap(os.path.join(path, "codes.npy"), mode = "w+", dtype = int32, shape = (chrOffsets[-1],))
+    offsets = open_memmap(os.path.join(path, "offsets.npy"), mode = "w+", dtype = int64, shape = (population.nChr, len(population) + 1))
+    for c, table in enumerate(population.tables):
+        starts[chrOffsets[c]:chrOffsets[c + 1]] = table.starts
+        codes[chrOffsets[c]:chrOffsets[c + 1]] = table.codes
+        offsets[c] = table.offsets
+    del starts, codes, offsets
+    save(os.path.join(path, "chrOffsets.npy"), chrOffsets)
+    header = dict(names = names, diploid = diploid,
+                  chromosomes = [dict(name = t.name, cM = t.cM, interference = str(t.interference)) for t in population.tables],
+                  parentLabels = list(parentLabels))
+    with open(os.path.join(path, "population.json"), "w") as headerFile:
+        json.dump(header, headerFile)
+
+def loadPopulation(path):
+    """Opens a snapshot written by savePopulation as a HaploidPopulation, or DiploidPopulation, whose segment tables are views of
+       memory-mapped files, so individuals are only read from disk when they are used.  The parent codes are used in place when they match the
+       parent table of this process (as they do when the founders are interned in the same order); otherwise they are translated on loading."""
+    with open(os.path.join(path, "population.json")) as headerFile:
+        header = json.load(headerFile)
+    starts = load(os.path.join(path, "starts.npy"), mmap_mode = "r")
+    codes = load(os.path.join(path, "codes.npy"), mmap_mode = "r")
+    offsets = load(os.path.join(path, "offsets.npy"), mmap_mode = "r")
+    chrOffsets = load(os.path.join(path, "chrOffsets.npy"))
+    translation = array([internParent(label) for label in header["parentLabels"]], dtype = int32)
+    if not array_equal(translation, arange(len(translation))):
+        codes = translation[codes]
+    tables = [SegmentTable(name = chrom["name"], cM = chrom["cM"], interference = chrom["interference"],
+                           starts = starts[chrOffsets[c]:chrOffsets[c + 1]],
+                           codes = codes[chrOffsets[c]:chrOffsets[c + 1]],
+                           offsets = offsets[c])
+              for c, chrom in enumerate(header["chromosomes"])]
+    if header.get("diploid"):
+        return DiploidPopulation(haplotypes = HaploidPopulation(tables = tables), names = header["names"])
+    return HaploidPopulation(tables = tables, names = header["names"])
+
+
+if __name__ == '__main__':
+    founders = HaploidPopulation(names = ["a","b","c","d","e","f","g","h"], newChr = 2)
+    population = founders
+    for _ in range(10):
+        population = population.mate(random.randint(0, len(population), size = 1000),
+                                     random.randint(0, len(population), size = 1000))
+    for chr in population[0].chromosomes:
+        print "Chr %s: %s" % (chr.name, chr.segments)
+
+    #snapshots of diploids load as the same DiploidPopulation
+    import tempfile
+    diploids = DiploidPopulation(names = ["a", "b"], newChr = 2).mate([0, 1], [1, 1]).mate([0, 1, 0], [1, 1, 0])
+    diploids.names = ["x", "y", "z"]
+    path = tempfile.mkdtemp()
+    savePopulation(diploids, path)
+    loaded = loadPopulation(path)
+    same = isinstance(loaded, DiploidPopulation) and loaded.names == diploids.names and all(
+        [array_equal(a.starts, b.starts) and array_equal(a.codes, b.codes) and array_equal(a.offsets, b.offsets)
+         for a, b in itertools.izip(loaded.tables, diploids.tables)])
+    savePopulation(diploids.toIndividuals(), path)
+    same = same and all([a.chromosome_set == b.chromosome_set for a, b in itertools.izip(loadPopulation(path), diploids)])
+    print "Diploid snapshot round trip: %s" % ("ok" if same else "FAILED")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Results.py
+
+Binary, columnar storage for the results of simulation replicates.  A results directory holds
+chunk files (.npz, one array per column, each chunk covering a run of replicates) and an
+index.json listing the chunks and columns, so results can be appended to by later runs and
+loaded with NumPy alone.  Scalar columns hold one value per replicate; array columns, such as
+founder frequencies or segment lengths, hold the arrays of all replicates of a chunk
+concatenated along their first axis, with the offset of each replicate in a column named
+<column>Offsets, as in a SegmentTable.
+"""
+from __future__ import division
+import os
+import json
+
+from numpy import *
+
+
+class ResultsWriter(object):
+    """Appends the results of replicates to the results directory path, writing a chunk every chunkSize replicates.
+       Each replicate is a dictionary of columns: numbers, or arrays of any number of rows with the same shape otherwise."""
+    def __init__(self, path, chunkSize = 100):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.rows = list()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as indexFile:
+                self.index = json.load(indexFile)
+        else:
+            self.index = dict(columns = None, chunks = list(), replicates = 0)
+
+    indexPath = property(fget = lambda self: os.path.join(self.path, "index.json"), doc = "Path of the index file")
+
+    def write(self, row):
+        """Adds the results of one replicate, writing a chunk if chunkSize replicates are waiting"""
+        columns = dict((key, "scalar" if isscalar(value) else "array") for key, value in row.items())
+        if self.index["columns"] == None:
+            self.index["columns"] = columns
+        elif columns != self.index["columns"]:
+            raise ValueError, "Replicate results must have the same columns as the results already in %s" % self.path
+        self.rows.append(row)
+        if len(self.rows) >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        """Writes the waiting replicates as a new chunk and updates the index"""
+        if len(self.rows) == 0:
+            return
+        arrays = dict()
+        for key, kind in self.index["columns"].items():
+            values = [row[key] for row in self.rows]
+            if kind == "scalar":
+                arrays[key] = array(values)
+            else:
+                values = [asarray(value) for value in values]
+                arrays[key] = concatenate(values)
+                arrays[key + "Offsets"] = concatenate(([0], cumsum([len(value) for value in values]))).astype(int64)
+        name = "chunk-%05d.npz" % len(self.index["chunks"])
+        savez(os.path.join(self.path, name), **arrays)
+        self.index["chunks"].append(dict(file = name, replicates = len(self.rows)))
+        self.index["replicates"] += len(self.rows)
+        self.rows = list()
+        #replace the index in one step, so that it never lists a chunk that is not complete
+        with open(self.indexPath + ".tmp", "w") as indexFile:
+            json.dump(self.index, indexFile)
+        os.rename(self.indexPath + ".tmp", self.indexPath)
+
+    def close(self):
+        self.flush()
+
+
+def iterChunks(path):
+    """Columns of each chunk of the results directory path in turn; array columns are lists with the array of each replicate"""
+    with open(os.path.join(path, "index.json")) as indexFile:
+        index = json.load(indexFile)
+    for chunk in index["chunks"]:
+        arrays = load(os.path.join(path, chunk["file"]))
+        columns = dict()
+        for key, kind in index["columns"].items():
+            if kind == "scalar":
+                columns[key] = arrays[key]
+            else:
+                values, offsets = arrays[key], arrays[key + "Offsets"]
+                columns[key] = [values[offsets[i]:offsets[i + 1]] for i in xrange(len(offsets) - 1)]
+        yield columns
+
+def loadResults(path):
+    """Columns of all replicates in the results directory path: an array for each scalar column, and for each array column
+       a list with the array of each replicate"""
+    columns = dict()
+    for chunk in iterChunks(path):
+        for key, values in chunk.items():
+            columns.setdefault(key, list()).append(values)
+    for key, chunks in columns.items():
+        if isinstance(chunks[0], list):
+            columns[key] = [value for values in chunks for value in values]
+        else:
+            columns[key] = concatenate(chunks)
+    return columns
+
+
+if __name__ == '__main__':
+    import tempfile
+    path = tempfile.mkdtemp()
+    writer = ResultsWriter(path, chunkSize = 2)
+    for rep in range(5):
+        writer.write(dict(replicate = rep, mean = random.uniform(), lengths = random.uniform(size = random.randint(1, 5))))
+    writer.close()
+    results = loadResults(path)
+    print results["replicate"], results["mean"]
+    print [len(lengths) for lengths in results["lengths"]]
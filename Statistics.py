@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Statistics.py
+
+Population level statistics computed on segment tables rather than individual chromosomes.
+"""
+from __future__ import division
+import itertools
+
+from numpy import *
+from Chromosomes import *
+import Population
+import Ancestry
+
+
+def populationTables(population, chunkSize = 1024):
+    """Lists of SegmentTables, one for each chromosome, that together hold a population: a HaploidPopulation,
+       DiploidPopulation (both chromosome sets of each individual), AncestryPopulation, SegmentTable, or list or
+       iterable of haploids.  Iterables, such as the stream from Crosses.iterRandInfCross, are read in chunks of
+       chunkSize individuals, so they are never held in memory all at once."""
+    if isinstance(population, SegmentTable):
+        yield [population]
+    elif isinstance(population, (Population.HaploidPopulation, Population.DiploidPopulation)):
+        yield population.tables
+    elif isinstance(population, Ancestry.AncestryPopulation):
+        yield population.toPopulation().tables
+    elif isinstance(population, list):
+        if len(population) > 0:
+            yield [SegmentTable(chromosomes = list(chrs)) for chrs in itertools.izip(*[ind.chromosomes for ind in population])]
+    else:
+        population = iter(population)
+        while True:
+            chunk = list(itertools.islice(population, chunkSize))
+            if len(chunk) == 0:
+                break
+            yield [SegmentTable(chromosomes = list(chrs)) for chrs in itertools.izip(*[ind.chromosomes for ind in chunk])]
+
+def segmentTables(population, chrom = 0, chunkSize = 1024):
+    """SegmentTables for one chromosome of a population; see populationTables"""
+    for tables in populationTables(population, chunkSize):
+        yield tables[chrom]
+
+def gridLocations(cM, interval = 1):
+    """Evenly spaced locations every interval cM along a chromosome, including both ends"""
+    return arange(0, cM + interval/2, interval) / cM
+
+def codeCounts(codes, founderCodes):
+    """(sites x founders) counts of each founder code in each row of a (sites x individuals) matrix of parent codes"""
+    nCodes = max(codes.max(), founderCodes.max()) + 1
+    counts = bincount((codes + nCodes * arange(len(codes))[:, newaxis]).ravel(), minlength = nCodes * len(codes))
+    return counts.reshape(len(codes), nCodes)[:, founderCodes]
+
+def founderFrequencies(population, founders, interval = 1, chrom = 0):
+    """(sites x founders) counts of the individuals carrying each founder's segment, at sites every interval cM"""
+    founderCodes = array([internParent(f) for f in founders])
+    freqs = 0
+    for table in segmentTables(population, chrom):
+        freqs = freqs + codeCounts(table.getCodesAtLocations(gridLocations(table.cM, interval)), founderCodes)
+    return freqs
+
+def coverageStats(freqs, lowCount = 20):
+    """Founder coverage summaries of a (sites x founders) frequency matrix.
+       missing and low are the per-site counts of absent founders and founders below lowCount, scaled by the number of founders;
+       anyMissing and anyLow are the fractions of sites with at least one such founder."""
+    nSites, nFounders = freqs.shape
+    missing = freqs == 0
+    low = freqs < lowCount
+    return dict(missing = missing.sum() / nSites * nFounders,
+                low = low.sum() / nSites * nFounders,
+                anyMissing = missing.any(axis = 1).sum() / nSites,
+                anyLow = low.any(axis = 1).sum() / nSites)
+
+def breakpoints(starts):
+    """Sorted unique segment boundaries, as fractions of the chromosome, from a list of segment start arrays for one chromosome
+       (such as the starts of SegmentTables, or earlier breakpoints).  Both ends of the chromosome are included."""
+    return unique(concatenate([[0.0, 1.0]] + list(starts)))
+
+def segmentLengths(breaks, cM):
+    """Lengths in cM of the segments that no individual has a recombination breakpoint within"""
+    return diff(breaks) * cM
+
+def lengthStats(lengths, quantiles = (0.05, 0.25, 0.5, 0.75, 0.95), bins = 20, histRange = None):
+    """Summary of a segment length distribution: count, mean, variance, longest, median, the given quantiles,
+       and a histogram as (counts, bin edges) over histRange (by default from 0 to the longest segment)"""
+    if histRange == None:
+        histRange = (0, max(lengths.max(), 1e-12) if len(lengths) > 0 else 1)
+    counts, edges = histogram(lengths, bins = bins, range = histRange)
+    if len(lengths) == 0:
+        return dict(n = 0, mean = nan, var = nan, max = nan, median = nan, quantiles = dict((q, nan) for q in quantiles),
+                    histogram = (counts, edges))
+    return dict(n = len(lengths), mean = lengths.mean(), var = lengths.var(), max = lengths.max(), median = median(lengths),
+                quantiles = dict(itertools.izip(quantiles, percentile(lengths, [100 * q for q in quantiles]))),
+                histogram = (counts, edges))
+
+def segmentStats(chromosomes, breaks, quantiles = (0.05, 0.25, 0.5, 0.75, 0.95), bins = 20):
+    """Segment length distributions from the breakpoints of each chromosome (as from breakpoints()), for chromosomes given as
+       SegmentTables or other objects with name and cM.  Returns a dictionary with the lengths and lengthStats of each chromosome,
+       by name, and genome-wide, with the histograms on common bins."""
+    lengths = [segmentLengths(chrBreaks, chrom.cM) for chrom, chrBreaks in itertools.izip(chromosomes, breaks)]
+    genome = concatenate(lengths)
+    histRange = (0, max(genome.max(), 1e-12) if len(genome) > 0 else 1)
+    return dict(chromosomes = dict((chrom.name, dict(lengths = chrLengths, stats = lengthStats(chrLengths, quantiles, bins, histRange)))
+                                   for chrom, chrLengths in itertools.izip(chromosomes, lengths)),
+                genome = dict(lengths = genome, stats = lengthStats(genome, quantiles, bins, histRange)))
+
+def populationSegmentStats(population, quantiles = (0.05, 0.25, 0.5, 0.75, 0.95), bins = 20):
+    """Segment length distributions of every chromosome of a population, in one pass over it; see segmentStats"""
+    chromosomes = None
+    for tables in populationTables(population):
+        if chromosomes == None:
+            chromosomes = tables
+            breaks = [breakpoints([table.starts]) for table in tables]
+        else:
+            breaks = [breakpoints([chrBreaks, table.starts]) for table, chrBreaks in itertools.izip(tables, breaks)]
+    if chromosomes == None:
+        raise ValueError, "No individuals in the population"
+    return segmentStats(chromosomes, breaks, quantiles, bins)
+
+
+def codesAt(population, chrom, rows, locs):
+    """Parent codes of individuals rows of a HaploidPopulation or AncestryPopulation at locations locs of chromosome chrom
+       (rows and locs are broadcast against each other)"""
+    if isinstance(population, Ancestry.AncestryPopulation):
+        return population.tables.roots.tables[chrom].getCodesAt(population.getAncestorsAt(chrom, rows, locs), locs)
+    return population.tables[chrom].getCodesAt(rows, locs)
+
+class GenerationStats(object):
+    """Statistics of every batched generation of a cross, collected incrementally as a time series.
+       Once attach()ed as a mate observer (see Population.addMateObserver), each generation updates the parent codes of
+       its individuals at sites every interval cM from those of its parents and the crossovers of its meioses, so the
+       segments of the offspring are never queried; parents are only looked up at the crossovers, and at every site when
+       they were not the last generation observed.  Each generation records:
+         individuals (chromosome sets, for a DiploidPopulation), crossovers, merged (crossovers between parents with
+         the same founder, which leave no junction), junctions (crossovers that made one), meanSegment (genome wide
+         mean length in cM of the runs of sites with the same founder), lost (founders absent at every site), the
+         coverageStats of the founder frequencies, and the (sites x founders) frequencies themselves."""
+    def __init__(self, founders, interval = 1, lowCount = 20):
+        self.founders = list(founders)
+        self.founderCodes = array([internParent(f) for f in founders])
+        self.interval = interval
+        self.lowCount = lowCount
+        #sites of each chromosome, and the (individuals x sites) codes of the last generation observed
+        self.chromosomes = None
+        self.sites = None
+        self.population = None
+        self.siteCodes = None
+        self.generations = list()
+
+    def attach(self):
+        Population.addMateObserver(self)
+
+    def detach(self):
+        Population.removeMateObserver(self)
+        self.population = None
+        self.siteCodes = None
+
+    def __call__(self, parents, offspring, rowsA, rowsB, counts, crossOvers, fromA):
+        if self.sites is None:
+            if isinstance(parents, Ancestry.AncestryPopulation):
+                self.chromosomes = [(table.name, table.cM) for table in parents.tables.roots.tables]
+            else:
+                self.chromosomes = [(table.name, table.cM) for table in parents.tables]
+            self.sites = [gridLocations(cM, self.interval) for name, cM in self.chromosomes]
+        self.siteCodes = self.parentSiteCodes(parents)
+        merged = 0
+        siteCodes = list()
+        meioses = arange(len(rowsA))
+        for chrom, sites in enumerate(self.sites):
+            crossMeiosis = repeat(meioses, counts[chrom])
+            #both parents of every crossover from one lookup, so that the parents' table is searched once
+            crossCodes = codesAt(parents, chrom, concatenate((rowsA[crossMeiosis], rowsB[crossMeiosis])), tile(crossOvers[chrom], 2))
+            merged += (crossCodes[:len(crossMeiosis)] == crossCodes[len(crossMeiosis):]).sum()
+            #crossovers of each meiosis before each site, from one search of complex keys (meiosis + 1j * position)
+            before = (searchsorted(crossMeiosis + 1j * crossOvers[chrom], meioses[:, newaxis] + 1j * sites[newaxis, :]) -
+                      (cumsum(counts[chrom]) - counts[chrom])[:, newaxis])
+            useA = (before % 2 == 0) == fromA[chrom][:, newaxis]
+            siteCodes.append(where(useA, self.siteCodes[chrom][rowsA], self.siteCodes[chrom][rowsB]))
+        self.population = offspring
+        self.siteCodes = siteCodes
+        nCrossOvers = sum(len(chrCrossOvers) for chrCrossOvers in crossOvers)
+        self.record(len(rowsA), nCrossOvers, merged)
+
+    def parentSiteCodes(self, parents):
+        """Codes of the parents at the sites of each chromosome: those of the last generation observed if the parents are
+           it, or were joined from it by Population.joinPopulations, and otherwise looked up in the parents' segments"""
+        if parents is self.population:
+            return self.siteCodes
+        parts = [part() for part in getattr(parents, "parts", [])]
+        if self.population in parts and None not in parts:
+            partCodes = [self.parentSiteCodes(part) for part in parts]
+            return [concatenate(chrCodes) for chrCodes in itertools.izip(*partCodes)]
+        return [codesAt(parents, chrom, arange(len(parents))[:, newaxis], sites[newaxis, :])
+                for chrom, sites in enumerate(self.sites)]
+
+    def record(self, nIndividuals, nCrossOvers, merged):
+        freqs = concatenate([codeCounts(codes.T, self.founderCodes) for codes in self.siteCodes])
+        runs = sum(nIndividuals + (codes[:, 1:] != codes[:, :-1]).sum() for codes in self.siteCodes)
+        generation = dict(individuals = nIndividuals, crossovers = nCrossOvers, merged = merged, junctions = nCrossOvers - merged,
+                          meanSegment = nIndividuals * sum(cM for name, cM in self.chromosomes) / runs,
+                          lost = (freqs.sum(axis = 0) == 0).sum(), frequencies = freqs)
+        generation.update(coverageStats(freqs, self.lowCount))
+        self.generations.append(generation)
+
+    def series(self):
+        """The time series as a dictionary of columns, one entry per generation (frequencies is a (generations x sites x
+           founders) array), with the chromosome and cM position of each site and the founders"""
+        columns = dict(generation = arange(1, len(self.generations) + 1))
+        for key in ("individuals", "crossovers", "merged", "junctions", "meanSegment", "lost", "missing", "low", "anyMissing", "anyLow"):
+            columns[key] = array([generation[key] for generation in self.generations])
+        chromosomes = self.chromosomes or []
+        sites = self.sites or []
+        columns["frequencies"] = array([generation["frequencies"] for generation in self.generations]).reshape(
+            len(self.generations), sum(len(chrSites) for chrSites in sites), len(self.founders))
+        columns["siteChromosome"] = array([name for (name, cM), chrSites in itertools.izip(chromosomes, sites) for _ in chrSites])
+        columns["sitePosition"] = concatenate([zeros(0)] + [chrSites * cM for (name, cM), chrSites in itertools.izip(chromosomes, sites)])
+        columns["founders"] = array(self.founders)
+        return columns
+
+    def save(self, path):
+        """Writes the time series to path as a compressed .npz file of its columns"""
+        savez_compressed(path, **self.series())
+
+def saveSeries(path, series):
+    """Writes the time series of several replicates (from GenerationStats.series) to path as one compressed .npz file,
+       with a replicate column.  The site and founder columns are those of the first replicate with any generations."""
+    columns = dict(replicate = concatenate([repeat(rep, len(s["generation"])) for rep, s in enumerate(series)] + [zeros(0, dtype = int)]))
+    observed = [s for s in series if len(s["generation"]) > 0] or series[:1]
+    for key in series[0]:
+        if key in ("siteChromosome", "sitePosition", "founders"):
+            columns[key] = observed[0][key]
+        else:
+            columns[key] = concatenate([s[key] for s in observed])
+    savez_compressed(path, **columns)